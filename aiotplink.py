@@ -0,0 +1,181 @@
+'''
+Asyncio client for the TP-Link cloud (Python 3 only, needs aiohttp).
+
+Mirrors tplink.TPLink and device.Plug/Bulb, building exactly the same
+request payloads, but every device shares one pooled aiohttp session, so
+many commands can be awaited at once without a thread each:
+
+    async with AsyncTPLink() as client:
+        await client.login()
+        devices = await client.getDevices()
+        results = await command(devices, 'on', deadline=5)
+
+The synchronous classes in tplink.py and device.py remain the way to talk
+to devices from Python 2 and from the worker threads.
+'''
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from tplink import TPLink
+from device import Device, Plug, Bulb, GroupResult, DeadlineExceeded, _METHODS
+
+
+class AsyncTPLink(object):
+    """ Cloud login and device listing over one shared connection pool of
+        at most limit connections.
+    """
+
+    def __init__(self, endpoint=None, uuid=None, limit=8, timeout=10):
+        # TPLink does no I/O on construction; it holds the config and builds
+        # the payloads.
+        self.tplink = TPLink(endpoint, uuid)
+        self.endpoint = self.tplink.endpoint
+        self.limit = limit
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    @property
+    def token(self):
+        return self.tplink.token
+
+    async def post(self, data, params=None):
+        try:
+            async with self.session.post(self.endpoint, params=params, json=data) as resp:
+                return await resp.json(content_type=None)
+        except Exception as e:
+            logging.error(e)
+            raise e
+
+    async def login(self, username=None, password=None, uuid=None):
+        resp = await self.post(self.tplink._login_data(username, password, uuid))
+        self.tplink.token = resp['result']['token']
+        return resp
+
+    async def getDeviceList(self):
+        resp = await self.post(self.tplink._device_list_data())
+        try:
+            self.tplink._store_devices(resp)
+        except Exception as e:
+            logging.error(e)
+            raise e
+        return resp
+
+    async def getDevices(self):
+        resp = await self.getDeviceList()
+        devices = []
+        for spec in resp['result']['deviceList']:
+            cls = ASYNC_DEVICE_TYPES.get(spec.get('deviceType'))
+            if cls is None:
+                raise KeyError('No known deviceType: {}'.format(spec.get('deviceType')))
+            devices.append(cls(self, spec.get('deviceId'), spec.get('alias')))
+        return devices
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class AsyncDevice(object):
+
+    def __init__(self, client, deviceId, alias):
+        self.client = client
+        self.deviceId = deviceId
+        self.alias = alias
+
+    # the cloud payload is the same one the synchronous Device builds
+    _request_body = Device._request_body
+
+    async def _tplink_request(self, method, requestData):
+        return await self.client.post(self._request_body(method, requestData),
+                                      params={'token': self.client.token})
+
+
+class AsyncPlug(AsyncDevice):
+
+    async def _set_relay_state(self, value):
+        return await self._tplink_request(_METHODS.get('passthrough'), Plug.relay_state_data(value))
+
+    async def on(self):
+        return await self._set_relay_state(1)
+
+    async def off(self):
+        return await self._set_relay_state(0)
+
+
+class AsyncBulb(AsyncDevice):
+
+    async def _transition_light_state(self, **kwargs):
+        return await self._tplink_request(_METHODS.get('passthrough'), Bulb.light_state_data(**kwargs))
+
+    async def on(self):
+        return await self._transition_light_state(on_off=1)
+
+    async def off(self):
+        return await self._transition_light_state(on_off=0)
+
+    async def hue(self, hue):
+        return await self._transition_light_state(hue=hue)
+
+    async def saturation(self, saturation):
+        return await self._transition_light_state(saturation=saturation)
+
+    async def brightness(self, brightness):
+        return await self._transition_light_state(brightness=brightness)
+
+    async def color(self):
+        return await self._transition_light_state(color_temp=0)
+
+    async def white(self):
+        return await self._transition_light_state(color_temp=4000)
+
+
+ASYNC_DEVICE_TYPES = {
+    u'IOT.SMARTPLUGSWITCH': AsyncPlug,
+    u'IOT.SMARTBULB': AsyncBulb
+}
+
+
+async def _timed(device, action, args, kwargs):
+    start = time.time()
+    try:
+        return GroupResult(device, await getattr(device, action)(*args, **kwargs), None, time.time() - start)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        return GroupResult(device, None, e, time.time() - start)
+
+
+async def command(devices, action, *args, **kwargs):
+    """ Await action on every device at once and return a GroupResult per
+        device, like device.fan_out.  deadline= bounds the whole call.
+    """
+    deadline = kwargs.pop('deadline', 5.0)
+    tasks = [asyncio.ensure_future(_timed(device, action, args, kwargs)) for device in devices]
+    if tasks:
+        await asyncio.wait(tasks, timeout=deadline)
+    results = []
+    for device, task in zip(devices, tasks):
+        if task.done():
+            results.append(task.result())
+        else:
+            task.cancel()
+            results.append(GroupResult(device, None, DeadlineExceeded(
+                '{} did not answer within {}s'.format(device.alias, deadline)), None))
+    return results
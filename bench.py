@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Headless benchmark for the wand tracking pipeline.
+
+Runs recorded frames (a video file or a .npy stack, see replay.py) through
+preprocessing, detection, optical flow, gesture classification and drawing
+exactly as rpotter.py does, without a camera, window or devices, and
+reports per-stage timings, frames per second and per-frame latency
+percentiles.
+
+    python bench.py recording.npy
+    python bench.py recording.npy --no-roi --scale 1 --detector blob
+'''
+import argparse
+import time
+import numpy as np
+import cv2
+
+from preprocess import Preprocessor, STAGES
+from detection import HoughDetector, BlobDetector, PyramidDetector
+from tracker import RoiTracker, WandTracker
+from gestures import GestureClassifier
+from recognizer import TemplateRecognizer, StrokeCollector
+from overlay import draw_tracks, trail_mask
+from replay import ReplayCapture
+# the app's own tracking and gesture settings, so the benchmark can't drift from them
+from rpotter import lk_params, GESTURES, roi_padding, detection_scale, redetect_interval
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+REPORT_STAGES = ('preprocess', 'detect', 'lk', 'gesture', 'draw')
+
+
+class _TimedDetector(object):
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.elapsed = 0.0
+
+    def detect(self, gray):
+        start = _clock()
+        try:
+            return self.detector.detect(gray)
+        finally:
+            self.elapsed += _clock() - start
+
+
+def build(args):
+    preprocessor = Preprocessor(timed=True)
+    for stage in args.disable:
+        preprocessor.disable(stage)
+    if args.equalize:
+        preprocessor.enable('equalize')
+    base = BlobDetector() if args.detector == 'blob' else HoughDetector()
+    detector = _TimedDetector(PyramidDetector(base, scale=args.scale))
+    roi = None if args.no_roi else RoiTracker(preprocessor, lk_params, pad=args.roi_padding)
+    tracker = WandTracker(preprocessor, detector, lk_params, roi=roi, interval=args.interval)
+    return preprocessor, detector, tracker
+
+
+def run(args):
+    preprocessor, detector, tracker = build(args)
+    classifier = GestureClassifier(GESTURES, max_tracks=10)
+    recognizer = TemplateRecognizer.load(args.templates) if args.templates else None
+    strokes = StrokeCollector(max_tracks=10)
+    cam = ReplayCapture(args.source, loop=args.loop)
+    timings = dict((stage, []) for stage in REPORT_STAGES)
+    latencies = []
+    spells = []
+    mask = None
+    frames = 0
+    try:
+        while args.frames is None or frames < args.frames:
+            rval, frame = cam.read()
+            if not rval:
+                break
+            cv2.flip(frame, 1, frame)
+            if mask is None:
+                mask = trail_mask(frame)
+            started = _clock()
+            prep_before = sum(preprocessor.timings.values())
+            detect_before = detector.elapsed
+
+            good_new, good_old = tracker.update(frame)
+            tracked = _clock()
+            preprocess = sum(preprocessor.timings.values()) - prep_before
+            detect = detector.elapsed - detect_before
+
+            spell = None
+            if not tracker.redetected:
+                spell = classifier.classify(good_new, good_old)
+                if recognizer:
+                    for track, stroke in strokes.add(good_new):
+                        spell = spell or recognizer.recognize(stroke)[0]
+            else:
+                classifier.reset()
+                strokes.reset()
+                mask[:] = 0
+            if spell:
+                spells.append((frames, spell))
+            classified = _clock()
+
+            if not args.no_draw:
+                draw_tracks(frame, mask, good_new, good_old)
+            done = _clock()
+
+            timings['preprocess'].append(preprocess)
+            timings['detect'].append(detect)
+            timings['lk'].append(tracked - started - preprocess - detect)
+            timings['gesture'].append(classified - tracked)
+            timings['draw'].append(done - classified)
+            latencies.append(done - started)
+            frames += 1
+    finally:
+        cam.release()
+    return frames, timings, latencies, spells, preprocessor
+
+
+def report(frames, timings, latencies, spells, preprocessor):
+    if not frames:
+        print('No frames read')
+        return
+    total = sum(latencies)
+    print('frames: {}  fps: {:.1f}'.format(frames, frames / total if total else float('inf')))
+    latencies = np.array(latencies) * 1000.0
+    print('latency ms  p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}'.format(
+        np.percentile(latencies, 50), np.percentile(latencies, 90),
+        np.percentile(latencies, 99), latencies.max()))
+    print('{:<12}{:>10}{:>10}{:>10}'.format('stage', 'mean ms', 'p99 ms', 'share'))
+    for stage in REPORT_STAGES:
+        values = np.array(timings[stage]) * 1000.0
+        print('{:<12}{:>10.3f}{:>10.3f}{:>9.1f}%'.format(
+            stage, values.mean(), np.percentile(values, 99), 100.0 * values.sum() / (total * 1000.0)))
+    print('preprocess stages (mean ms over calls):')
+    for stage in STAGES:
+        if preprocessor.counts[stage]:
+            print('  {:<10}{:>10.3f}'.format(stage, 1000.0 * preprocessor.timings[stage] / preprocessor.counts[stage]))
+    for frame, spell in spells:
+        print('spell at frame {}: {}'.format(frame, spell))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the wand tracking pipeline on recorded frames.')
+    parser.add_argument('source', help='video file or .npy frame stack')
+    parser.add_argument('--frames', type=int, help='stop after this many frames')
+    parser.add_argument('--loop', action='store_true', help='loop the recording (use with --frames)')
+    parser.add_argument('--no-roi', action='store_true', help='track over full frames')
+    parser.add_argument('--roi-padding', type=int, default=roi_padding)
+    parser.add_argument('--scale', type=float, default=detection_scale, help='detection pyramid scale (1 disables)')
+    parser.add_argument('--detector', choices=('hough', 'blob'), default='hough')
+    parser.add_argument('--interval', type=float, default=redetect_interval, help='seconds between re-detections')
+    parser.add_argument('--disable', action='append', default=[], choices=STAGES,
+                        help='disable a preprocessing stage (repeatable)')
+    parser.add_argument('--equalize', action='store_true', help='enable equalizeHist')
+    parser.add_argument('--no-draw', action='store_true', help='skip drawing the overlay')
+    parser.add_argument('--templates', help='gesture templates to run the recognizer with')
+    args = parser.parse_args()
+    report(*run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+'''
+Camera backends.
+
+Every backend reads frames like cv2.VideoCapture does, read(image=None)
+returning (rval, frame) and writing into image when it can, so FrameGrabber
+and the rest of the pipeline don't care where frames come from:
+
+    OpenCVCamera     a V4L2 (or any OpenCV) capture device
+    PiCamera         the Pi camera through picamera, as grayscale Y planes
+    SyntheticCamera  a drawn wand tip tracing gestures, for tests
+    replay.ReplayCapture  recorded frames
+
+open_camera() picks one by name.
+'''
+import numpy as np
+import cv2
+
+from replay import ReplayCapture, _pace
+
+
+class OpenCVCamera(object):
+    """ cv2.VideoCapture on device index, through V4L2 where OpenCV has it
+        (on the Pi that needs the bcm2835-v4l2 module).  Frames are BGR.
+    """
+
+    def __init__(self, index=0, resolution=(640, 480), v4l2=True):
+        api = getattr(cv2, 'CAP_V4L2', None) if v4l2 else None
+        self.capture = cv2.VideoCapture(index, api) if api is not None else cv2.VideoCapture(index)
+        if not self.capture.isOpened() and api is not None:
+            self.capture = cv2.VideoCapture(index)
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def read(self, image=None):
+        return self.capture.read(image) if image is not None else self.capture.read()
+
+    def get(self, prop):
+        return self.capture.get(prop)
+
+    def set(self, prop, value):
+        return self.capture.set(prop, value)
+
+    def release(self):
+        self.capture.release()
+
+
+class PiCamera(object):
+    """ The Pi camera through picamera's capture_continuous on the video
+        port, capturing YUV420 straight into one preallocated array.
+
+        With gray=True (the default) a frame is the Y plane of that array,
+        which is the grayscale image the tracker wants, so there is no BGR
+        decode and no cvtColor; read(image) copies just the Y plane into
+        image.  With gray=False frames are converted to BGR, for display.
+    """
+
+    def __init__(self, resolution=(640, 480), framerate=32, gray=True):
+        import picamera
+        self.width, self.height = resolution
+        self.gray = gray
+        # picamera pads YUV frames to a width of 32 and a height of 16
+        self.padded = ((self.width + 31) // 32 * 32, (self.height + 15) // 16 * 16)
+        pw, ph = self.padded
+        self.yuv = np.empty(pw * ph * 3 // 2, np.uint8)
+        self.y = self.yuv[:pw * ph].reshape(ph, pw)[:self.height, :self.width]
+        self.camera = picamera.PiCamera(resolution=resolution, framerate=framerate)
+        self.frames = self.camera.capture_continuous(self.yuv, format='yuv', use_video_port=True)
+
+    def isOpened(self):
+        return not self.camera.closed
+
+    def read(self, image=None):
+        try:
+            next(self.frames)
+        except StopIteration:
+            return False, None
+        if self.gray:
+            frame = self.y
+        else:
+            pw, ph = self.padded
+            frame = cv2.cvtColor(self.yuv.reshape(ph * 3 // 2, pw), cv2.COLOR_YUV2BGR_I420)[:self.height, :self.width]
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, np.array(frame)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.camera.framerate)
+        return 0
+
+    def set(self, prop, value):
+        # the resolution is fixed once capture_continuous is running
+        return False
+
+    def release(self):
+        self.frames.close()
+        self.camera.close()
+
+
+# (dx, dy) per frame and number of frames for each leg of a stroke.  This
+# one casts Lumos: FrameGrabber mirrors frames, so moving left in camera
+# space reads as "right", then "up".
+LUMOS = [((-8, 0), 15), ((0, -8), 15), ((0, 0), 30)]
+
+
+class SyntheticCamera(object):
+    """ Draws a bright wand tip moving along strokes (see LUMOS) over a
+        dark, slightly noisy background, starting again from start once the
+        strokes are done.  With fps set, read() paces itself like a camera.
+    """
+
+    def __init__(self, resolution=(640, 480), strokes=LUMOS, start=(400, 300), radius=6,
+                 fps=None, gray=False, noise=8, seed=0):
+        self.width, self.height = resolution
+        self.strokes = strokes
+        self.start = start
+        self.radius = radius
+        self.fps = fps
+        self.noise = noise
+        self.shape = (self.height, self.width) if gray else (self.height, self.width, 3)
+        self.random = np.random.RandomState(seed)
+        self.position = 0
+        self._next = None
+        self._path = self._trace()
+
+    def _trace(self):
+        x, y = self.start
+        path = [(x, y)]
+        for (dx, dy), frames in self.strokes:
+            for i in range(frames):
+                x, y = x + dx, y + dy
+                path.append((x, y))
+        return path
+
+    def isOpened(self):
+        return True
+
+    def read(self, image=None):
+        _pace(self)
+        if image is None or image.shape != self.shape or image.dtype != np.uint8:
+            image = np.empty(self.shape, np.uint8)
+        if self.noise:
+            image[...] = self.random.randint(0, self.noise, self.shape)
+        else:
+            image[...] = 0
+        x, y = self._path[self.position % len(self._path)]
+        cv2.circle(image, (int(x), int(y)), self.radius, (255, 255, 255), -1)
+        self.position += 1
+        return True, image
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps or 0
+        return 0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        pass
+
+
+BACKENDS = ('auto', 'opencv', 'picamera', 'synthetic')
+
+
+def _importable(name):
+    """ Whether module name can be found, without importing it. """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2
+        import imp
+        try:
+            imp.find_module(name)
+            return True
+        except ImportError:
+            return False
+    return find_spec(name) is not None
+
+
+def open_camera(backend='auto', resolution=(640, 480), gray=False, replay=None, loop=False, fps=None):
+    """ Open a camera by backend name; replay (a recording, see
+        replay.ReplayCapture) overrides it.  'auto' uses picamera when it
+        is installed and OpenCV otherwise.  gray is a hint: PiCamera and
+        SyntheticCamera then deliver single-channel frames.
+    """
+    if replay:
+        return ReplayCapture(replay, loop=loop, fps=fps)
+    if backend == 'auto':
+        backend = 'picamera' if _importable('picamera') else 'opencv'
+    if backend == 'picamera':
+        return PiCamera(resolution, gray=gray)
+    if backend == 'opencv':
+        return OpenCVCamera(0, resolution)
+    if backend == 'synthetic':
+        return SyntheticCamera(resolution, fps=fps, gray=gray)
+    raise KeyError('No known camera backend: {}'.format(backend))
@@ -0,0 +1,139 @@
+import threading
+import logging
+import numpy as np
+import cv2
+
+from metrics import METRICS
+
+
+class FrameGrabber(threading.Thread):
+    """ A capture thread that reads frames from the camera into a small ring
+        of preallocated arrays, so that tracking never waits on camera I/O.
+
+        The drop policy is "latest frame wins": if the consumer has not
+        picked up the newest frame by the time the next one is captured, the
+        older one is discarded and counted as dropped.
+
+        Frames returned by read() belong to the consumer until the next
+        call to read(); the grabber never writes into that slot.
+
+        Ask the thread to stop by calling its join() method.  It stops by
+        itself once a camera with an ended attribute (a recording) says it
+        has run out, setting ended.
+    """
+
+    def __init__(self, cam, slots=3, flip=True):
+        super(FrameGrabber, self).__init__()
+        if slots < 3:
+            raise ValueError('FrameGrabber needs at least 3 slots, got {}'.format(slots))
+        self.daemon = True
+        self.cam = cam
+        self.slots = slots
+        self.flip = flip
+        self.stoprequest = threading.Event()
+        self.captured = 0
+        self.processed = 0
+        self.dropped = 0
+        self.ended = False
+        self._frames = None
+        self._latest = -1
+        self._held = -1
+        self._fresh = False
+        self._cond = threading.Condition()
+
+    def _next_slot(self):
+        for offset in range(1, self.slots + 1):
+            slot = (self._latest + offset) % self.slots
+            if slot != self._latest and slot != self._held:
+                return slot
+
+    def _grab(self):
+        # capture_wait is the camera read, mostly waiting for the next frame
+        # (paced by the camera); capture is what the grabber itself costs:
+        # copying, flipping and handing the frame over
+        if self._frames is None:
+            with METRICS.timer('capture_wait'):
+                rval, frame = self.cam.read()
+            if not rval:
+                return False
+            with METRICS.timer('capture'):
+                self._frames = [np.empty_like(frame) for x in range(self.slots)]
+                slot = 0
+                np.copyto(self._frames[slot], frame)
+                self._hand_over(slot)
+            return True
+        with self._cond:
+            slot = self._next_slot()
+        with METRICS.timer('capture_wait'):
+            rval, frame = self.cam.read(self._frames[slot])
+        if not rval:
+            return False
+        with METRICS.timer('capture'):
+            if frame is not self._frames[slot]:
+                # the backend ignored our buffer (e.g. resolution changed)
+                self._frames[slot] = frame
+            self._hand_over(slot)
+        return True
+
+    def _hand_over(self, slot):
+        if self.flip:
+            cv2.flip(self._frames[slot], 1, self._frames[slot])
+        with self._cond:
+            if self._fresh:
+                self.dropped += 1
+                METRICS.count('frames_dropped')
+            self._latest = slot
+            self._fresh = True
+            self.captured += 1
+            self._cond.notify_all()
+        METRICS.count('frames_captured')
+
+    def run(self):
+        logging.info("Starting FrameGrabber")
+        while not self.stoprequest.isSet():
+            try:
+                if not self._grab():
+                    if getattr(self.cam, 'ended', False):
+                        logging.info("End of stream")
+                        with self._cond:
+                            self.ended = True
+                            self._cond.notify_all()
+                        break
+                    self.stoprequest.wait(0.01)
+            except Exception as e:
+                logging.error("Capture Error: {}".format(e))
+                self.stoprequest.wait(0.1)
+
+    def read(self, timeout=1.0):
+        """ Block until a frame newer than the last one read is available and
+            return (True, frame), or (False, None) on timeout or once the
+            stream has ended.
+        """
+        with self._cond:
+            if not self._fresh and not self.ended:
+                self._cond.wait(timeout)
+            if not self._fresh:
+                return False, None
+            self._held = self._latest
+            self._fresh = False
+            self.processed += 1
+            return True, self._frames[self._held]
+
+    def snapshot(self):
+        """ Return a copy of the newest frame without consuming it. """
+        with self._cond:
+            if self._latest < 0:
+                return False, None
+            return True, self._frames[self._latest].copy()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'captured': self.captured,
+                'processed': self.processed,
+                'dropped': self.dropped
+            }
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(FrameGrabber, self).join(timeout)
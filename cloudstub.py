@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+A stand-in for the TP-Link cloud endpoint, for trying out latency and
+failures locally.
+
+It answers login, getDeviceList and passthrough requests the way the
+cloud does, after latency seconds, and can be told to fail: fail_next
+requests (or a fail_rate share of them) get a 503, and while down it drops
+connections without answering.  Point tplink.yaml's endpoint at it, or use
+it from Python:
+
+    cloud = StubCloud(latency=0.2, fail_rate=0.1).start()
+    session = tplink.Session(tplink.TPLink(cloud.endpoint, 'uuid'), cache_file=None)
+    ...
+    cloud.stop()
+
+    python cloudstub.py --port 8080 --latency 0.5 --fail-rate 0.2
+'''
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+import sys
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+DEVICES = [
+    {'deviceId': 'stub-plug', 'alias': 'Stub Plug', 'deviceType': 'IOT.SMARTPLUGSWITCH'},
+    {'deviceId': 'stub-bulb', 'alias': 'Stub Bulb', 'deviceType': 'IOT.SMARTBULB'},
+]
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        cloud = self.server.cloud
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, answer = cloud._answer(body)
+        if status is None:
+            # down: hang up without a response
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        payload = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubCloud(object):
+    """ A local cloud endpoint with injectable latency and failures. """
+
+    def __init__(self, devices=DEVICES, host='127.0.0.1', port=0, latency=0.0, fail_rate=0.0, fail_next=0):
+        self.devices = [dict(spec) for spec in devices]
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_next = fail_next
+        self.down = False
+        self.requests = []
+        self.states = dict((spec['deviceId'], {}) for spec in self.devices)
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), _Handler)
+        self.server.cloud = self
+        self.host, self.port = self.server.server_address[:2]
+
+    @property
+    def endpoint(self):
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    def _fail(self):
+        with self._lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return True
+        return random.random() < self.fail_rate
+
+    def _answer(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.down:
+            return None, None
+        if self._fail():
+            return 503, {'error_code': -1, 'msg': 'Injected failure'}
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, {'error_code': -10100, 'msg': 'JSON format error'}
+        with self._lock:
+            self.requests.append(request)
+        method = request.get('method')
+        params = request.get('params', {})
+        if method == 'login':
+            return 200, {'error_code': 0, 'result': {'token': 'stub-token'}}
+        if method == 'getDeviceList':
+            return 200, {'error_code': 0, 'result': {'deviceList': self.devices}}
+        if method == 'passthrough':
+            state = self.states.get(params.get('deviceId'))
+            if state is None:
+                return 200, {'error_code': -20571, 'msg': 'Device is offline'}
+            responseData = self._passthrough(state, json.loads(params['requestData']))
+            return 200, {'error_code': 0, 'result': {'responseData': json.dumps(responseData)}}
+        return 200, {'error_code': -20103, 'msg': 'Method not found'}
+
+    def _passthrough(self, state, requestData):
+        response = {}
+        for module, methods in requestData.items():
+            response[module] = {}
+            for method, args in methods.items():
+                if method == 'set_relay_state':
+                    state['relay_state'] = args['state']
+                    answer = {}
+                elif method == 'transition_light_state':
+                    state.update((k, v) for k, v in args.items() if k != 'transition_period')
+                    answer = dict(state)
+                elif method == 'get_sysinfo':
+                    answer = dict(state, light_state=dict(state), relay_state=state.get('relay_state', 0))
+                else:
+                    answer = {}
+                answer['err_code'] = 0
+                response[module][method] = answer
+        return response
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a stand-in TP-Link cloud endpoint.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with a 503')
+    args = parser.parse_args()
+    cloud = StubCloud(host=args.host, port=args.port, latency=args.latency, fail_rate=args.fail_rate)
+    print('Serving {}'.format(cloud.endpoint))
+    try:
+        cloud.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cloud.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,5 @@
-_CONFIG_FILE = 'tplink.yaml'
\ No newline at end of file
+import os
+
+_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tplink.yaml')
+# Where the cloud token and device list are cached between runs
+_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tplink-cache.json')
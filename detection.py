@@ -0,0 +1,137 @@
+import numpy as np
+import cv2
+from abc import ABCMeta, abstractmethod
+
+
+def to_points(circles):
+    """ Convert an (n, 3) array of x, y, radius into the (n, 1, 2) float32
+        layout calcOpticalFlowPyrLK expects for p0, or None if empty.
+    """
+    if circles is None or len(circles) == 0:
+        return None
+    return np.ascontiguousarray(circles[:, 0:2], np.float32).reshape(-1, 1, 2)
+
+
+class Detector:
+    """ Finds wand tips in a preprocessed grayscale image.
+
+        circles() returns an (n, 3) float32 array of x, y, radius with the
+        strongest candidates first, or None.  scaled() returns an equivalent
+        detector for an image downscaled by the given factor.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def circles(self, gray):
+        pass
+
+    @abstractmethod
+    def scaled(self, scale):
+        pass
+
+    def detect(self, gray):
+        return to_points(self.circles(gray))
+
+
+class HoughDetector(Detector):
+
+    def __init__(self, dp=3, min_dist=50, param1=240, param2=8, min_radius=4, max_radius=15):
+        self.dp = dp
+        self.min_dist = min_dist
+        self.param1 = param1
+        self.param2 = param2
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+
+    def circles(self, gray):
+        found = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, self.dp, self.min_dist,
+                                 param1=self.param1, param2=self.param2,
+                                 minRadius=self.min_radius, maxRadius=self.max_radius)
+        if found is None:
+            return None
+        return found.reshape(-1, 3)
+
+    def scaled(self, scale):
+        return HoughDetector(dp=max(self.dp / float(scale), 1),
+                             min_dist=self.min_dist / float(scale),
+                             param1=self.param1, param2=self.param2,
+                             min_radius=max(int(self.min_radius / scale), 1),
+                             max_radius=max(int(round(self.max_radius / float(scale))), 2))
+
+
+class BlobDetector(Detector):
+    """ Threshold + connected components.  IR wand tips are saturated blobs
+        on the NoIR camera, so this is much cheaper than a Hough transform
+        and finds the same points.  Largest blobs come first.
+    """
+
+    def __init__(self, threshold=200, min_radius=2, max_radius=15, max_blobs=20):
+        self.threshold = threshold
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.max_blobs = max_blobs
+
+    def circles(self, gray):
+        rval, binary = cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        if count <= 1:
+            return None
+        # label 0 is the background
+        areas = stats[1:, cv2.CC_STAT_AREA].astype(np.float32)
+        radii = np.sqrt(areas / np.pi)
+        keep = np.nonzero((radii >= self.min_radius) & (radii <= self.max_radius))[0]
+        if len(keep) == 0:
+            return None
+        keep = keep[np.argsort(-areas[keep], kind='mergesort')][:self.max_blobs]
+        found = np.empty((len(keep), 3), np.float32)
+        found[:, 0:2] = centroids[1:][keep]
+        found[:, 2] = radii[keep]
+        return found
+
+    def scaled(self, scale):
+        return BlobDetector(threshold=self.threshold,
+                            min_radius=max(self.min_radius / float(scale), 0.5),
+                            max_radius=self.max_radius / float(scale),
+                            max_blobs=self.max_blobs)
+
+
+class PyramidDetector(Detector):
+    """ Coarse-to-fine detection: search a copy of the image downscaled by
+        scale, then refine each candidate with the full-resolution detector
+        inside a small window around it.  Candidates that don't survive
+        refinement are dropped.  With scale <= 1 this is just the wrapped
+        detector.
+    """
+
+    def __init__(self, detector, scale=2, refine_pad=None):
+        self.detector = detector
+        self.scale = scale
+        self.coarse = detector.scaled(scale) if scale > 1 else None
+        self.refine_pad = refine_pad
+
+    def circles(self, gray):
+        if self.coarse is None:
+            return self.detector.circles(gray)
+        height, width = gray.shape[:2]
+        small = cv2.resize(gray, (int(width / self.scale), int(height / self.scale)),
+                           interpolation=cv2.INTER_AREA)
+        candidates = self.coarse.circles(small)
+        if candidates is None:
+            return None
+        pad = self.refine_pad or int(2 * self.scale * (candidates[:, 2].max() + 2))
+        refined = []
+        for x, y, r in candidates * self.scale:
+            x0, y0 = max(int(x) - pad, 0), max(int(y) - pad, 0)
+            x1, y1 = min(int(x) + pad + 1, width), min(int(y) + pad + 1, height)
+            found = self.detector.circles(gray[y0:y1, x0:x1])
+            if found is None:
+                continue
+            # keep the refined circle closest to the coarse estimate
+            best = found[np.argmin((found[:, 0] + x0 - x) ** 2 + (found[:, 1] + y0 - y) ** 2)]
+            refined.append((best[0] + x0, best[1] + y0, best[2]))
+        if not refined:
+            return None
+        return np.array(refined, np.float32)
+
+    def scaled(self, scale):
+        return PyramidDetector(self.detector.scaled(scale), self.scale, self.refine_pad)
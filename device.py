@@ -1,23 +1,142 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import yaml
 import logging
+import threading
+import time
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from config import _CONFIG_FILE
+from kasa import LocalTransport, PORT as _LOCAL_PORT
+from resilience import Resilience, CircuitBreaker, DeadlineExceeded
+from metrics import METRICS
 
 _METHODS = {
     'passthrough': 'passthrough'
 }
 
+_SYSINFO_DATA = {"system": {"get_sysinfo": {}}}
+
+
+def _response_data(resp):
+    """ The decoded responseData of a passthrough response, or None.  The
+        cloud sends it as a JSON string, LocalTransport already decoded.
+    """
+    try:
+        data = resp['result']['responseData']
+        if not isinstance(data, dict):
+            data = json.loads(data)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return data
+
+
+class ConnectionPool(object):
+    """ One requests.Session for an endpoint, shared by every device that
+        talks to it, so commands reuse kept-alive TLS connections instead of
+        each device opening its own.
+
+        Up to pool_size connections are kept open (requests.Session is safe
+        to share between the fan_out threads).  Every request goes through
+        the pool's Resilience: it must be answered within deadline seconds,
+        each attempt also bounded by timeout (seconds or a (connect, read)
+        pair); idempotent requests that fail are retried up to retries
+        times with exponential backoff starting at backoff seconds; and
+        after failures consecutive failures the endpoint's circuit breaker
+        fails requests at once for reset_timeout seconds.  stats() counts
+        how many requests reused a pooled connection (hits) and how many
+        had to open one (misses).
+    """
+
+    def __init__(self, endpoint, pool_size=8, timeout=(3.05, 10), retries=2, backoff=0.3, keep_alive=True,
+                 deadline=10.0, max_backoff=2.0, failures=5, reset_timeout=30.0):
+        self.endpoint = endpoint
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        self.resilience = Resilience(deadline, retries, backoff, max_backoff,
+                                     CircuitBreaker(failures, reset_timeout))
+        self.borrowers = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ConnectionPool({})'.format(self.endpoint)
+
+    def borrow(self):
+        """ The shared session, for a device that will use it. """
+        with self._lock:
+            self.borrowers += 1
+        return self.session
+
+    def _timeout(self, remaining):
+        if self.timeout is None:
+            return remaining
+        if isinstance(self.timeout, tuple):
+            return tuple(min(t, remaining) for t in self.timeout)
+        return min(self.timeout, remaining)
+
+    def post(self, idempotent=False, deadline=None, **kwargs):
+        """ session.post(**kwargs) under the pool's deadline, retry and
+            circuit breaker policy; 5xx answers count as failures.
+        """
+        def attempt(remaining):
+            resp = self.session.post(timeout=self._timeout(remaining), **kwargs)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+        return self.resilience.call(attempt, idempotent, deadline)
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        requests_sent = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        stats = {
+            'devices': self.borrowers,
+            'requests': requests_sent,
+            'hits': requests_sent - connections,
+            'misses': connections
+        }
+        stats.update(self.resilience.stats())
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
 class Device:
     __metaclass__ = ABCMeta
 
-    def __init__(self, deviceId, alias, token=None, endpoint=None):
+    # Fields of state that set_state() compares against the cache.  The
+    # cache is filled from command responses and get_sysinfo(), and is
+    # trusted for state_ttl seconds after it was last confirmed.
+    state_fields = ()
+    state_ttl = 120
+
+    def __init__(self, deviceId, alias, token=None, endpoint=None, transport=None, pool=None):
         self.deviceId = deviceId
         self.alias = alias
         self.token = token
         self.endpoint = endpoint
-        self.session = requests.Session()
+        # a kasa.LocalTransport sends passthrough requests over the LAN
+        # instead of through the cloud
+        self.transport = transport
+        # devices built by DeviceFactory share the endpoint's pool
+        self.pool = pool or ConnectionPool(endpoint)
+        self.session = self.pool.borrow()
+        self.state = {}
+        self.state_updated = 0
+        self.skipped = 0
+        self._state_lock = threading.Lock()
 
     @property
     def alias(self):
@@ -51,8 +170,17 @@ class Device:
     def endpoint(self, endpoint):
         self._endpoint = endpoint
         
-    def _tplink_request(self, method, requestData):
-        self.session.params = {
+    def _request_body(self, method, requestData):
+        return {
+            "method": method,
+            "params": {
+                'deviceId': self.deviceId,
+                'requestData': json.dumps(requestData)
+            }
+        }
+
+    def _request_params(self):
+        return {
             # 'appName': 'Kasa_Android',
             # 'termID': self.uuid,
             # 'appVer': '1.4.4.607',
@@ -61,19 +189,97 @@ class Device:
             # 'locale': 'es_ES',
             'token': self.token
         }
-        data = {
-            "method": method,
-            "params": {
-                'deviceId': self.deviceId,
-                'requestData': json.dumps(requestData)
-            }
-        }
+
+    def _tplink_request(self, method, requestData):
+        local = self.transport is not None and method == _METHODS.get('passthrough')
+        with METRICS.timer('device_request', device=self.alias, transport='local' if local else 'cloud'):
+            try:
+                return self._send_request(method, requestData, local)
+            except Exception:
+                METRICS.count('device_errors', device=self.alias)
+                raise
+
+    def _send_request(self, method, requestData, local):
+        if local:
+            return self.transport.send(requestData)
+        # params are passed per request rather than set on the shared session
+        data = self._request_body(method, requestData)
         try:
-            return self.session.post(url=self.endpoint, json=data).json()
+            # passthrough commands set absolute states, so re-sending one is safe
+            return self.pool.post(url=self.endpoint, params=self._request_params(), json=data,
+                                  idempotent=method == _METHODS.get('passthrough')).json()
         except Exception as e:
             logging.error(e)
             raise e
 
+    def known_state(self):
+        """ A copy of the cached state, or {} if it is too old to trust. """
+        with self._state_lock:
+            if time.time() - self.state_updated > self.state_ttl:
+                return {}
+            return dict(self.state)
+
+    def _remember(self, state):
+        with self._state_lock:
+            self.state.update(state)
+            self.state_updated = time.time()
+
+    def forget(self):
+        with self._state_lock:
+            self.state = {}
+            self.state_updated = 0
+
+    def _state_request(self, requestData, read):
+        """ Send a passthrough request and update the cache with
+            read(responseData).  Anything unexpected (an exception, an error
+            code, a response read() can't parse) leaves the state unknown.
+        """
+        try:
+            resp = self._tplink_request(_METHODS.get('passthrough'), requestData)
+        except Exception:
+            self.forget()
+            raise
+        state = None
+        data = _response_data(resp)
+        if data is not None:
+            try:
+                state = read(data)
+            except (KeyError, TypeError, AttributeError):
+                state = None
+        if state is None:
+            self.forget()
+        else:
+            self._remember(state)
+        return resp
+
+    def get_sysinfo(self):
+        return self._state_request(_SYSINFO_DATA, lambda data: self._sysinfo_state(data['system']['get_sysinfo']))
+
+    def changes(self, state):
+        """ The fields of state that differ from the cached state. """
+        known = self.known_state()
+        return dict((k, v) for k, v in state.items() if k in self.state_fields and known.get(k) != v)
+
+    def set_state(self, **state):
+        """ Send only the fields of state that would change something, in a
+            single request; returns None without sending anything when the
+            device is known to be in that state already.
+        """
+        changes = self.changes(state)
+        if not changes:
+            with self._state_lock:
+                self.skipped += 1
+            return None
+        return self._send_state(changes, state)
+
+    @abstractmethod
+    def _sysinfo_state(self, info):
+        pass
+
+    @abstractmethod
+    def _send_state(self, changes, state):
+        pass
+
     @abstractmethod
     def on(self):
         pass
@@ -85,9 +291,24 @@ class Device:
 
 class Plug(Device):
 
+    state_fields = ('on_off',)
+
+    @staticmethod
+    def relay_state_data(value):
+        return {"system":{"set_relay_state":{"state": value }}}
+
+    def _sysinfo_state(self, info):
+        return {'on_off': info['relay_state']}
+
     def _set_relay_state(self, value):
-        requestData = {"system":{"set_relay_state":{"state": value }}}
-        return self._tplink_request(_METHODS.get('passthrough'), requestData)
+        requestData = self.relay_state_data(value)
+        def read(data):
+            if data['system']['set_relay_state'].get('err_code') == 0:
+                return {'on_off': value}
+        return self._state_request(requestData, read)
+
+    def _send_state(self, changes, state):
+        return self._set_relay_state(changes['on_off'])
 
     def on(self):
         return self._set_relay_state(1)
@@ -97,12 +318,37 @@ class Plug(Device):
 
 class Bulb(Device):
 
-    def _transition_light_state(self, **kwargs):
+    state_fields = ('on_off', 'hue', 'saturation', 'brightness', 'color_temp')
+
+    @staticmethod
+    def light_state_data(**kwargs):
          # on_off: 1 on, 0 on_off
          # hue: 0-360, saturation: 0-100, brightness: 0-100, color_temp:4000
          # See HSB in http://colorizer.org/
-        requestData = {"smartlife.iot.smartbulb.lightingservice": { "transition_light_state": kwargs } }
-        return self._tplink_request(_METHODS.get('passthrough'), requestData)
+        return {"smartlife.iot.smartbulb.lightingservice": { "transition_light_state": kwargs } }
+
+    @classmethod
+    def _light_state(cls, light_state):
+        # an off bulb reports the state it will turn on in as dft_on_state
+        state = dict(light_state.get('dft_on_state', {}))
+        state.update(light_state)
+        return dict((k, v) for k, v in state.items() if k in cls.state_fields)
+
+    def _sysinfo_state(self, info):
+        return self._light_state(info['light_state'])
+
+    def _transition_light_state(self, **kwargs):
+        requestData = self.light_state_data(**kwargs)
+        def read(data):
+            light_state = data["smartlife.iot.smartbulb.lightingservice"]["transition_light_state"]
+            if light_state.get('err_code') == 0:
+                return self._light_state(light_state)
+        return self._state_request(requestData, read)
+
+    def _send_state(self, changes, state):
+        if 'transition_period' in state:
+            changes['transition_period'] = state['transition_period']
+        return self._transition_light_state(**changes)
 
     def on(self):
         return self._transition_light_state(on_off=1)
@@ -116,12 +362,77 @@ class Bulb(Device):
     def saturation(self,saturation):
         return self._transition_light_state(saturation=saturation)
 
+    def brightness(self,brightness):
+        return self._transition_light_state(brightness=brightness)
+
     def color(self):
         return self._transition_light_state(color_temp=0)
 
     def white(self):
         return self._transition_light_state(color_temp=4000)
 
+    def light(self):
+        """ Start a LightState, to change several attributes in one request:
+            bulb.light().on().color().hue(120).saturation(100).send()
+        """
+        return LightState(self)
+
+
+class LightState(object):
+    """ Collects transition_light_state fields for one bulb and sends them
+        as a single request.  Each setter returns the LightState, so calls
+        chain; send() goes through Bulb.set_state(), skipping fields the
+        bulb is known to have already, unless force is given.
+    """
+
+    def __init__(self, bulb, **fields):
+        self.bulb = bulb
+        self.fields = fields
+
+    def _set(self, name, value, low, high):
+        if not low <= value <= high:
+            raise ValueError('{} must be between {} and {}, not {}'.format(name, low, high, value))
+        self.fields[name] = value
+        return self
+
+    def on(self):
+        self.fields['on_off'] = 1
+        return self
+
+    def off(self):
+        self.fields['on_off'] = 0
+        return self
+
+    def hue(self, hue):
+        return self._set('hue', hue, 0, 360)
+
+    def saturation(self, saturation):
+        return self._set('saturation', saturation, 0, 100)
+
+    def brightness(self, brightness):
+        return self._set('brightness', brightness, 0, 100)
+
+    def color_temp(self, color_temp):
+        # 0 switches to colour (hue/saturation) mode
+        if color_temp:
+            return self._set('color_temp', color_temp, 2500, 9000)
+        self.fields['color_temp'] = 0
+        return self
+
+    def color(self):
+        return self.color_temp(0)
+
+    def white(self):
+        return self.color_temp(4000)
+
+    def transition(self, milliseconds):
+        return self._set('transition_period', milliseconds, 0, 10000)
+
+    def send(self, force=False):
+        if force:
+            return self.bulb._transition_light_state(**self.fields)
+        return self.bulb.set_state(**self.fields)
+
 DEVICE_TYPES ={
     u'IOT.SMARTPLUGSWITCH': Plug,
     u'IOT.SMARTBULB': Bulb
@@ -146,6 +457,22 @@ class DeviceFactory:
 
         def __init__(self, endpoint):
             self.endpoint = endpoint or self.config['tplink']['endpoint']
+            self.pools = {}
+            self._lock = threading.Lock()
+
+        def pool(self, endpoint=None):
+            """ The shared ConnectionPool for endpoint, tuned by the `pool`
+                section of tplink.yaml.
+            """
+            endpoint = endpoint or self.endpoint
+            with self._lock:
+                if endpoint not in self.pools:
+                    self.pools[endpoint] = ConnectionPool(endpoint, **(self.config['tplink'].get('pool') or {}))
+                return self.pools[endpoint]
+
+        def stats(self):
+            with self._lock:
+                return dict((endpoint, pool.stats()) for endpoint, pool in self.pools.items())
 
         def __str__(self):
             return repr(self) + self.val
@@ -153,11 +480,15 @@ class DeviceFactory:
         def buildDevice(self, deviceSpec):
             type = deviceSpec.get('deviceType', None)
             if not type: raise ValueError('No deviceType was specified.')
-            device = DEVICE_TYPES.get(type, None)(
+            cls = DEVICE_TYPES.get(type, None)
+            if not cls: raise KeyError('No known deviceType: {}'.format(type))
+            device = cls(
                 deviceSpec.get('deviceId'),
                 deviceSpec.get('alias'),
-                endpoint=self.endpoint)
-            if not device: raise KeyError('No known deviceType: {}'.format(type))
+                endpoint=self.endpoint,
+                pool=self.pool())
+            if deviceSpec.get('host'):
+                device.transport = LocalTransport(deviceSpec['host'], deviceSpec.get('port', _LOCAL_PORT))
 
             return device
 
@@ -174,3 +505,70 @@ class DeviceFactory:
 
     def __setattr__(self, name, value):
         return setattr(self.instance, name, value)
+
+
+# One entry per device in a group command; error is None on success and
+# latency is in seconds (None if the device never answered).
+GroupResult = namedtuple('GroupResult', ['device', 'response', 'error', 'latency'])
+
+POOL_SIZE = 8
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPool(POOL_SIZE)
+        return _POOL
+
+
+def _timed_call(call, device):
+    start = time.time()
+    try:
+        return call(device), None, time.time() - start
+    except Exception as e:
+        return None, e, time.time() - start
+
+
+def fan_out(devices, call, deadline=5.0):
+    """ Run call(device) for every device concurrently on a shared, bounded
+        thread pool and return a GroupResult per device, in order.  Devices
+        that haven't answered deadline seconds after the call started are
+        reported with a DeadlineExceeded error.
+    """
+    pool = _pool()
+    until = time.time() + deadline
+    pending = [(device, pool.apply_async(_timed_call, (call, device))) for device in devices]
+    results = []
+    for device, pending_result in pending:
+        try:
+            response, error, latency = pending_result.get(max(until - time.time(), 0))
+        except Exception:
+            response, error, latency = None, DeadlineExceeded('{} did not answer within {}s'.format(device.alias, deadline)), None
+        results.append(GroupResult(device, response, error, latency))
+    return results
+
+
+class DeviceGroup(object):
+    """ Sends the same command to many devices at once.
+
+        group.on() and group.off() (or group.command('hue', 120)) return a
+        list of GroupResult instead of raising, so one unreachable device
+        doesn't stop the others.
+    """
+
+    def __init__(self, devices, deadline=5.0):
+        self.devices = list(devices)
+        self.deadline = deadline
+
+    def command(self, action, *args, **kwargs):
+        deadline = kwargs.pop('deadline', self.deadline)
+        return fan_out(self.devices, lambda device: getattr(device, action)(*args, **kwargs), deadline)
+
+    def on(self, **kwargs):
+        return self.command('on', **kwargs)
+
+    def off(self, **kwargs):
+        return self.command('off', **kwargs)
@@ -0,0 +1,431 @@
+import itertools
+import logging
+import threading
+import sys
+import time
+from collections import deque, namedtuple
+
+from device import GroupResult, _timed_call
+from metrics import METRICS
+
+is_py2 = sys.version[0] == '2'
+if is_py2: import Queue as queue
+else: import queue as queue
+
+# Key (and lane) for commands meant for every device: the handler hands
+# them on as entries on each device's lane, in the order they were cast.
+ALL_DEVICES = '*'
+
+
+def apply_state(device, state, session=None):
+    """ Send a desired state dict (transition_light_state fields) to a
+        device, skipping the fields it is known to be in already; returns
+        None if nothing was sent.  Plugs only understand on_off.  With a
+        tplink.Session the request goes through session.call, which logs
+        in again if the cloud rejects the token and raises CloudError for
+        any other error_code.
+    """
+    if session is None:
+        return device.set_state(**state)
+    return session.call(device, 'set_state', **state)
+
+
+def timed_state(device, state, session=None):
+    """ apply_state, reported as a GroupResult with the request latency. """
+    response, error, latency = _timed_call(lambda device: apply_state(device, state, session), device)
+    return GroupResult(device, response, error, latency)
+
+
+class Closed(Exception):
+    pass
+
+
+# A queued entry as handed out by CoalescingQueue.take(): enqueued is when
+# the oldest command merged into it was put, label what the latest put
+# called it (the spell that cast it), batches the ids of the submits it
+# carries out.
+Entry = namedtuple('Entry', ['key', 'item', 'enqueued', 'label', 'batches'])
+
+# What the Dispatcher records for every entry it runs: the Entry's key,
+# label and enqueue time, when a worker started and finished it, a
+# GroupResult per device request it made, the exception it raised, if any,
+# and its batches.  ResultSink publishes one per batch, combining those of
+# its entries.
+Record = namedtuple('Record', ['key', 'label', 'enqueued', 'started', 'finished', 'results', 'error', 'batches'])
+
+
+def _combine(batch, records):
+    records = sorted(records, key=lambda record: record.enqueued)
+    first = records[0]
+    errors = [record.error for record in records if record.error is not None]
+    return Record(first.key, first.label, first.enqueued,
+                  min(record.started for record in records), max(record.finished for record in records),
+                  tuple(result for record in records for result in record.results),
+                  errors[0] if errors else None, (batch,))
+
+
+class ResultSink(object):
+    """ Keeps the last maxlen records and hands each one to subscribers.
+
+        A batch is what one submit() to the Dispatcher led to: the entry
+        itself and the entries its handler submitted in turn, such as one
+        per device for an ALL_DEVICES command.  add() collects the Record
+        of each of those entries, and complete(batch) publishes them as one
+        Record, with the first entry's key and label, from when it was
+        queued until the last entry finished, every GroupResult and the
+        first error.
+
+        publish() never blocks on the sink itself: old records fall off the
+        end and a subscriber that raises is logged and skipped.  Subscribers
+        run on the publishing thread, so they should be quick (or hand the
+        record on to a queue of their own).
+    """
+
+    def __init__(self, maxlen=100):
+        self.records = deque(maxlen=maxlen)
+        self._parts = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def add(self, record):
+        """ Hold record until each of its batches is complete. """
+        with self._lock:
+            for batch in record.batches:
+                self._parts.setdefault(batch, []).append(record)
+
+    def complete(self, batch):
+        """ Publish the records added for batch as one. """
+        with self._lock:
+            records = self._parts.pop(batch, None)
+        if records:
+            self.publish(_combine(batch, records))
+
+    def publish(self, record):
+        with self._lock:
+            self.records.append(record)
+            self.published += 1
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(record)
+            except Exception as e:
+                logging.error("Result subscriber {} failed: {}".format(callback, e))
+
+    def recent(self, n=None):
+        with self._lock:
+            records = list(self.records)
+        return records if n is None else records[-n:]
+
+
+class CoalescingQueue(object):
+    """ A queue that keeps at most one pending entry per key.
+
+        put() never blocks.  Putting a dict for a key that is already
+        waiting merges it into the pending dict (later fields win); putting
+        anything else replaces the pending item.  Either way the key keeps
+        its place in line, unless that would move it ahead of a later entry
+        it shares a lane with, in which case it goes to the back; the
+        superseded command is counted in coalesced instead of being
+        executed.
+
+        Every entry occupies one or more lanes: its key, and whatever lanes
+        it was put with (say the ids of all the bulbs an effect drives).
+        get() returns (key, item) pairs oldest first, skipping an entry
+        while one of its lanes is in flight, or taken by an older entry that
+        is still waiting, so entries that share a lane run one at a time
+        and in the order they were put.  A lane is in flight from get()
+        until task_done(key).  get() raises queue.Empty on timeout, like
+        Queue.get; take() returns the same as an Entry, with when and as
+        what it was queued.  Entries put with long_running=True are handed
+        out only while fewer than max_long of them are in flight.
+
+        Entries are put on behalf of batches (see ResultSink), and merging
+        adds the batches of the new command to the pending entry.
+        task_done() returns the batches that no longer have an entry
+        waiting or in flight.
+
+        After close(), put() raises Closed (unless force is given and the
+        queue is draining) and get() raises Closed once nothing is waiting
+        or in flight.
+    """
+
+    def __init__(self, max_long=None):
+        self.max_long = max_long
+        self._pending = {}
+        self._enqueued = {}
+        self._labels = {}
+        self._lanes = {}
+        self._batches = {}
+        self._outstanding = {}
+        self._long = set()
+        self._order = deque()
+        self._in_flight = {}
+        self._busy = set()
+        self._long_in_flight = 0
+        self._closed = False
+        self._draining = False
+        self._cond = threading.Condition()
+        self.puts = 0
+        self.coalesced = 0
+
+    @property
+    def depth(self):
+        with self._cond:
+            return len(self._order)
+
+    def qsize(self):
+        return self.depth
+
+    def put(self, key, item, long_running=False, label=None, lanes=(), batches=(), force=False):
+        """ Queue item under key, also occupying lanes; returns True if it
+            was merged into (or replaced) an entry that was already waiting.
+            force lets an entry in while a closed queue drains, for work
+            that the entries in flight hand on.
+        """
+        with self._cond:
+            if self._closed and not (force and self._draining):
+                raise Closed('Queue is closed')
+            self.puts += 1
+            if long_running:
+                self._long.add(key)
+            self._labels[key] = label
+            lanes = frozenset(lanes) | frozenset([key])
+            if key in self._pending:
+                pending = self._pending[key]
+                if isinstance(pending, dict) and isinstance(item, dict):
+                    merged = dict(pending)
+                    merged.update(item)
+                    item = merged
+                self._pending[key] = item
+                self._lanes[key] = self._lanes[key] | lanes
+                added = tuple(batch for batch in batches if batch not in self._batches[key])
+                self._batches[key] += added
+                self._count(added, 1)
+                later = list(self._order)[list(self._order).index(key) + 1:]
+                if any(self._lanes[other] & self._lanes[key] for other in later):
+                    self._order.remove(key)
+                    self._order.append(key)
+                self.coalesced += 1
+                self._cond.notify_all()
+                return True
+            self._pending[key] = item
+            self._enqueued[key] = time.time()
+            self._lanes[key] = lanes
+            self._batches[key] = tuple(batches)
+            self._count(batches, 1)
+            self._order.append(key)
+            self._cond.notify_all()
+            return False
+
+    def _count(self, batches, n):
+        done = []
+        for batch in batches:
+            self._outstanding[batch] = self._outstanding.get(batch, 0) + n
+            if self._outstanding[batch] <= 0:
+                del self._outstanding[batch]
+                done.append(batch)
+        return done
+
+    def _ready(self):
+        blocked = set(self._busy)
+        for key in self._order:
+            lanes = self._lanes[key]
+            if (lanes & blocked or
+                    key in self._long and self.max_long is not None and self._long_in_flight >= self.max_long):
+                blocked |= lanes
+                continue
+            return key
+        return None
+
+    def _finished(self):
+        return self._closed and not self._order and not self._in_flight
+
+    def get(self, block=True, timeout=None):
+        entry = self.take(block, timeout)
+        return entry.key, entry.item
+
+    def take(self, block=True, timeout=None):
+        with self._cond:
+            key = self._ready()
+            if block and key is None:
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while key is None and not self._finished():
+                    if timeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    key = self._ready()
+            if key is None:
+                if self._finished():
+                    raise Closed('Queue is closed')
+                raise queue.Empty()
+            self._order.remove(key)
+            lanes = self._lanes.pop(key)
+            batches = self._batches.pop(key)
+            self._in_flight[key] = lanes, batches
+            self._busy |= lanes
+            if key in self._long:
+                self._long_in_flight += 1
+            return Entry(key, self._pending.pop(key), self._enqueued.pop(key), self._labels.pop(key), batches)
+
+    def task_done(self, key):
+        """ Release key's lanes; returns the batches it completed. """
+        with self._cond:
+            lanes, batches = self._in_flight.pop(key, (frozenset(), ()))
+            self._busy -= lanes
+            if key in self._long:
+                self._long_in_flight -= 1
+                if key not in self._pending:
+                    self._long.discard(key)
+            self._cond.notify_all()
+            return self._count(batches, -1)
+
+    def close(self, drain=True):
+        """ Stop accepting entries; without drain, drop the waiting ones and
+            return them as Entries.  Their batches stay outstanding until
+            release(entry.batches).
+        """
+        with self._cond:
+            self._closed = True
+            self._draining = drain
+            dropped = []
+            if not drain:
+                dropped = [Entry(key, self._pending.pop(key), self._enqueued.pop(key), self._labels.pop(key),
+                                 self._batches.pop(key)) for key in self._order]
+                self._lanes.clear()
+                self._order.clear()
+            self._cond.notify_all()
+            return dropped
+
+    def release(self, batches):
+        """ Count off an entry that was dropped rather than run; returns the
+            batches it completed, like task_done().
+        """
+        with self._cond:
+            return self._count(batches, -1)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._order),
+                'in_flight': len(self._in_flight),
+                'puts': self.puts,
+                'coalesced': self.coalesced
+            }
+
+
+class Dispatcher(object):
+    """ Runs queued device commands on a pool of worker threads.
+
+        Entries are keyed by device (see CoalescingQueue), so commands for
+        one device run in order, one at a time, while different devices are
+        served in parallel; an entry that drives several devices, like an
+        effect, takes all their lanes.  Long-running entries such as effects
+        may only occupy max_long workers (all but one by default), so on/off
+        commands always have a worker available.
+
+        handler(key, item) does the work and may return the GroupResults of
+        the device requests it made.  It may also submit() further entries,
+        for instance one per device for a command meant for all of them;
+        those are accepted even while close() drains the queue, and are part
+        of the same batch.  Every entry run, whether it succeeded or raised,
+        is added to sink as a Record, and sink publishes each batch as one
+        once all its entries have run.  close() shuts down gracefully, by
+        default after draining what is queued.
+    """
+
+    def __init__(self, handler, workers=4, max_long=None, sink=None):
+        self.handler = handler
+        self.sink = sink if sink is not None else ResultSink()
+        if max_long is None:
+            max_long = max(workers - 1, 1)
+        self.queue = CoalescingQueue(max_long)
+        self._local = threading.local()
+        self._batch = itertools.count(1)
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='Dispatcher-{}'.format(i))
+            thread.daemon = True
+            self.threads.append(thread)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def submit(self, key, item, long_running=False, label=None, lanes=()):
+        """ Queue item for key, also holding lanes, without blocking;
+            returns True if it superseded a command that was still waiting.
+            label names the command in its Record.  Submitted from a
+            handler, the entry joins the batch of the entry being run, and
+            label defaults to that entry's.
+        """
+        current = getattr(self._local, 'entry', None)
+        if current is None:
+            batches = (next(self._batch),)
+        else:
+            batches = current.batches
+            if label is None:
+                label = current.label
+        return self.queue.put(key, item, long_running, label, lanes, batches, force=current is not None)
+
+    def _work(self):
+        while True:
+            try:
+                entry = self.queue.take()
+            except Closed:
+                return
+            started = time.time()
+            results, error = (), None
+            self._local.entry = entry
+            try:
+                results = self.handler(entry.key, entry.item) or ()
+            except Exception as e:
+                logging.error("{} failed: {}".format(entry.key, e))
+                error = e
+                METRICS.count('dispatch_errors', command=entry.label or entry.key)
+            finally:
+                self._local.entry = None
+            record = Record(entry.key, entry.label, entry.enqueued, started, time.time(), tuple(results), error,
+                            entry.batches)
+            # added before task_done, so it is in when the last entry of the batch completes it
+            self.sink.add(record)
+            for batch in self.queue.task_done(entry.key):
+                self.sink.complete(batch)
+            METRICS.observe('dispatch_wait', record.started - record.enqueued, command=record.label or record.key)
+            METRICS.observe('dispatch_run', record.finished - record.started, command=record.label or record.key)
+
+    def close(self, drain=True, timeout=None):
+        """ Stop the workers once the queue is empty (or at once, dropping
+            waiting commands, without drain) and wait up to timeout seconds
+            for them.  Dropped commands are recorded with a Closed error.
+        """
+        for entry in self.queue.close(drain):
+            # dropped commands complete their batches with a Closed error
+            now = time.time()
+            self.sink.add(Record(entry.key, entry.label, entry.enqueued, now, now, (),
+                                 Closed('Dropped when the dispatcher closed'), entry.batches))
+            for batch in self.queue.release(entry.batches):
+                self.sink.complete(batch)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(None if deadline is None else max(deadline - time.time(), 0))
+
+    def stats(self):
+        return self.queue.stats()
@@ -0,0 +1,130 @@
+import logging
+import time
+from collections import namedtuple
+
+from device import fan_out
+
+# state is passed to Bulb._transition_light_state; the bulb animates to it
+# over duration seconds by itself (transition_period).
+Keyframe = namedtuple('Keyframe', ['state', 'duration'])
+
+WHITE = {'color_temp': 4000, 'transition_period': 0}
+
+
+def hue_sweep(start=0, end=360, duration=7.2, steps=3, saturation=100):
+    """ Keyframes that turn the bulbs on in colour mode at hue start and then
+        sweep to end in steps transitions.  Each step must stay under 180
+        degrees, since bulbs take the short way round the colour wheel.
+    """
+    keyframes = [Keyframe({'on_off': 1, 'color_temp': 0, 'saturation': saturation, 'hue': start}, 0)]
+    for step in range(1, steps + 1):
+        hue = int(round(start + (end - start) * step / float(steps)))
+        keyframes.append(Keyframe({'hue': hue}, duration / float(steps)))
+    return keyframes
+
+
+class Scene(object):
+    """ A named light state (transition_light_state fields) for bulbs.
+
+        apply() sends it to all bulbs at once, one request per bulb with
+        every field in it (or only those that would change, through
+        Bulb.set_state, unless force), and returns a GroupResult per bulb.
+        transition is in milliseconds, as for LightState.transition().
+        With session (a tplink.Session) requests go through session.call,
+        like Effect's.
+    """
+
+    def __init__(self, name, state):
+        self.name = name
+        self.state = state
+
+    def __repr__(self):
+        return 'Scene({!r}, {!r})'.format(self.name, self.state)
+
+    def apply(self, bulbs, transition=None, force=False, deadline=5.0, session=None):
+        state = dict(self.state)
+        if transition is not None:
+            state['transition_period'] = int(transition)
+        action = '_transition_light_state' if force else 'set_state'
+        if session is None:
+            call = lambda bulb: getattr(bulb, action)(**state)
+        else:
+            call = lambda bulb: session.call(bulb, action, **state)
+        results = fan_out(bulbs, call, deadline)
+        for result in results:
+            if result.error is not None:
+                logging.error('{} {}: {}'.format(self.name, result.device.alias, result.error))
+        return results
+
+
+SCENES = dict((scene.name, scene) for scene in [
+    Scene('white', dict(WHITE, on_off=1)),
+    Scene('warm', {'on_off': 1, 'color_temp': 2700, 'brightness': 60}),
+    Scene('night', {'on_off': 1, 'color_temp': 2700, 'brightness': 5}),
+    Scene('red', {'on_off': 1, 'color_temp': 0, 'hue': 0, 'saturation': 100, 'brightness': 100}),
+    Scene('off', {'on_off': 0}),
+])
+
+
+def apply_scene(name, bulbs, **kwargs):
+    """ Apply SCENES[name] to bulbs; see Scene.apply. """
+    return SCENES[name].apply(bulbs, **kwargs)
+
+
+class Effect(object):
+    """ Plays keyframes on many bulbs at once.
+
+        Each keyframe is a single transition_light_state request per bulb,
+        sent to all bulbs concurrently, with the bulbs doing the animation
+        themselves; the effect just waits for the transition to finish.
+        run() returns early, within the time it takes to send one request,
+        when the stop event is set, and always finishes by sending finish to
+        every bulb.  results holds a GroupResult for every request the last
+        run() sent.  With session (a tplink.Session) requests go through
+        session.call, so a rejected token is renewed and cloud errors end
+        up in results.
+    """
+
+    def __init__(self, bulbs, keyframes, finish=WHITE, deadline=5.0, session=None):
+        self.bulbs = list(bulbs)
+        self.keyframes = keyframes
+        self.finish = finish
+        self.deadline = deadline
+        self.session = session
+        self.results = []
+
+    def _send(self, state):
+        if self.session is None:
+            call = lambda bulb: bulb._transition_light_state(**state)
+        else:
+            call = lambda bulb: self.session.call(bulb, '_transition_light_state', **state)
+        results = fan_out(self.bulbs, call, self.deadline)
+        for result in results:
+            if result.error is not None:
+                logging.error('{}: {}'.format(result.device.alias, result.error))
+        self.results.extend(results)
+        return results
+
+    def run(self, stop=None):
+        """ Play the effect; returns False if it was stopped early. """
+        completed = True
+        self.results = []
+        try:
+            for keyframe in self.keyframes:
+                if stop is not None and stop.isSet():
+                    completed = False
+                    break
+                started = time.time()
+                state = dict(keyframe.state, transition_period=int(keyframe.duration * 1000))
+                self._send(state)
+                remaining = keyframe.duration - (time.time() - started)
+                if remaining > 0:
+                    if stop is None:
+                        time.sleep(remaining)
+                    elif stop.wait(remaining):
+                        completed = False
+                        break
+        finally:
+            if self.finish:
+                self._send(self.finish)
+        return completed
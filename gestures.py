@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+# cooldowns must not jump when the wall clock is set (NTP on the Pi)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+DIRECTIONS = ('none', 'left', 'right', 'up', 'down')
+_CODES = dict((name, code) for code, name in enumerate(DIRECTIONS))
+
+
+def _automaton(pattern):
+    """ KMP transition table for a sequence of direction codes: row is the
+        number of pattern steps matched so far, column the next direction.
+    """
+    n = len(pattern)
+    table = np.zeros((n + 1, len(DIRECTIONS)), np.int16)
+    fallback = 0
+    for state in range(n + 1):
+        for code in range(1, len(DIRECTIONS)):
+            if state < n and pattern[state] == code:
+                table[state, code] = state + 1
+            elif state > 0:
+                table[state, code] = table[fallback, code]
+        if 0 < state < n:
+            fallback = table[fallback, pattern[state]]
+    # directionless frames leave the state alone
+    table[:, 0] = np.arange(n + 1)
+    return table
+
+
+class GestureClassifier(object):
+    """ Classifies the movement of all tracked points at once.
+
+        Each frame, classify() turns the displacement of every point into a
+        direction (left, right, up, down or none) with one vectorised pass,
+        records it in a fixed-length circular buffer per track, and advances
+        a small state machine per (track, pattern) pair.  A pattern such as
+        ('right', 'up') matches when those directions are seen consecutively
+        on one track, ignoring frames with no clear direction.  Nothing grows
+        with session length.
+
+        patterns is an ordered list of (name, directions); earlier patterns
+        win when several complete on the same frame.
+    """
+
+    def __init__(self, patterns, max_tracks=10, history=16, step=5, straightness=(2, 5)):
+        self.names = [name for name, directions in patterns]
+        codes = [[_CODES[d] for d in directions] for name, directions in patterns]
+        self.lengths = np.array([len(c) for c in codes], np.int16)
+        tables = [_automaton(c) for c in codes]
+        depth = max(t.shape[0] for t in tables)
+        self.tables = np.zeros((len(tables), depth, len(DIRECTIONS)), np.int16)
+        for i, table in enumerate(tables):
+            self.tables[i, :table.shape[0]] = table
+        self.max_tracks = max_tracks
+        self.step = step
+        self.straightness = straightness
+        self.directions = np.zeros((max_tracks, history), np.int8)
+        self.head = 0
+        self.states = np.zeros((max_tracks, len(patterns)), np.int16)
+        self._patterns = np.arange(len(patterns))
+
+    def reset(self):
+        self.directions[:] = 0
+        self.states[:] = 0
+
+    def moves(self, good_new, good_old):
+        """ Direction code for each point, in the same order. """
+        dx = good_new[:, 0] - good_old[:, 0]
+        dy = good_new[:, 1] - good_old[:, 1]
+        flat_y = np.abs(dy) < self.straightness[0]
+        flat_x = np.abs(dx) < self.straightness[1]
+        return np.select(
+            [(dx < -self.step) & flat_y,
+             (dx > self.step) & flat_y,
+             (dy < -self.step) & flat_x,
+             (dy > self.step) & flat_x],
+            [_CODES['left'], _CODES['right'], _CODES['up'], _CODES['down']],
+            _CODES['none']).astype(np.int8)
+
+    def history(self, track):
+        """ Recorded directions for a track, oldest first. """
+        row = np.roll(self.directions[track], -self.head)
+        return [DIRECTIONS[code] for code in row if code]
+
+    def classify(self, good_new, good_old):
+        """ Feed one frame of point displacements (k, 2) and return the name
+            of a completed pattern, or None.  Only the first max_tracks
+            points are considered.  Completing a pattern clears all tracks.
+        """
+        n = min(len(good_new), self.max_tracks)
+        if n == 0:
+            return None
+        codes = self.moves(good_new[:n].reshape(-1, 2), good_old[:n].reshape(-1, 2))
+        self.directions[:n, self.head] = codes
+        self.directions[n:, self.head] = 0
+        self.head = (self.head + 1) % self.directions.shape[1]
+        states = self.tables[self._patterns, self.states[:n], codes[:, None]]
+        self.states[:n] = states
+        done = states == self.lengths
+        if not done.any():
+            return None
+        track, pattern = np.argwhere(done)[0]
+        self.reset()
+        return self.names[pattern]
+
+
+class Cooldown(object):
+    """ Suppresses repeat casts of the same spell by timestamp, so the
+        tracking loop never has to sleep after a cast.
+
+        durations maps spell names to cooldowns in seconds; spells not in it
+        use default.
+    """
+
+    def __init__(self, default=3.1, durations=None, clock=_monotonic):
+        self.default = default
+        self.durations = dict(durations or {})
+        self.clock = clock
+        self.last = {}
+        self.suppressed = 0
+
+    def duration(self, spell):
+        return self.durations.get(spell, self.default)
+
+    def remaining(self, spell, now=None):
+        if spell not in self.last:
+            return 0.0
+        now = self.clock() if now is None else now
+        return max(self.last[spell] + self.duration(spell) - now, 0.0)
+
+    def ready(self, spell, now=None):
+        return self.remaining(spell, now) <= 0
+
+    def trigger(self, spell, now=None):
+        """ Record a cast of spell and return True, or return False if it is
+            still cooling down.
+        """
+        now = self.clock() if now is None else now
+        if not self.ready(spell, now):
+            self.suppressed += 1
+            return False
+        self.last[spell] = now
+        return True
+
+    def reset(self, spell=None):
+        if spell is None:
+            self.last.clear()
+        else:
+            self.last.pop(spell, None)
@@ -0,0 +1,190 @@
+'''
+Local (LAN) transport for TP-Link Kasa devices.
+
+Kasa plugs and bulbs accept the same JSON requests the cloud passthrough
+forwards to them on port 9999, obfuscated with an XOR autokey cipher.
+Over TCP each message is prefixed with its length as a 4-byte big-endian
+integer; over UDP it isn't, which is what broadcast discovery uses.
+'''
+import json
+import logging
+import socket
+import struct
+import threading
+
+PORT = 9999
+_KEY = 171
+
+_SYSINFO = {"system": {"get_sysinfo": {}}}
+
+
+def encrypt(data):
+    """ XOR autokey: each byte is XORed with the previous cipher byte. """
+    key = _KEY
+    out = bytearray()
+    for byte in bytearray(data):
+        key = key ^ byte
+        out.append(key)
+    return bytes(out)
+
+
+def decrypt(data):
+    key = _KEY
+    out = bytearray()
+    for byte in bytearray(data):
+        out.append(key ^ byte)
+        key = byte
+    return bytes(out)
+
+
+def _encode(requestData):
+    return encrypt(json.dumps(requestData).encode('utf-8'))
+
+
+def _decode(data):
+    return json.loads(decrypt(data).decode('utf-8'))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise IOError('Connection closed with {} bytes left to read'.format(size))
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class LocalTransport(object):
+    """ Sends requestData payloads straight to a device on the LAN.
+
+        Responses are wrapped like the cloud's passthrough answers,
+        {'error_code': 0, 'result': {'responseData': ...}}, except that
+        responseData is already decoded.
+    """
+
+    def __init__(self, host, port=PORT, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'LocalTransport({}:{})'.format(self.host, self.port)
+
+    def request(self, requestData):
+        payload = _encode(requestData)
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            sock.sendall(struct.pack('>I', len(payload)) + payload)
+            size = struct.unpack('>I', _recv_exactly(sock, 4))[0]
+            return _decode(_recv_exactly(sock, size))
+        finally:
+            sock.close()
+
+    def send(self, requestData):
+        try:
+            return {'error_code': 0, 'result': {'responseData': self.request(requestData)}}
+        except Exception as e:
+            logging.error('{}: {}'.format(self, e))
+            raise e
+
+
+def discover(timeout=2.0, address='255.255.255.255', port=PORT):
+    """ Broadcast get_sysinfo and return a device spec for every device that
+        answers within timeout, in the shape getDeviceList uses plus 'host'.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.settimeout(timeout)
+    found = {}
+    try:
+        sock.sendto(_encode(_SYSINFO), (address, port))
+        while True:
+            try:
+                data, (host, sender_port) = sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            try:
+                info = _decode(data)['system']['get_sysinfo']
+            except (ValueError, KeyError, TypeError):
+                continue
+            found[host] = {
+                'deviceId': info.get('deviceId'),
+                'alias': info.get('alias'),
+                'deviceType': info.get('type') or info.get('mic_type'),
+                'host': host,
+                'port': sender_port
+            }
+    finally:
+        sock.close()
+    return list(found.values())
+
+
+class StubDevice(object):
+    """ A stand-in Kasa device for local testing: answers get_sysinfo over
+        UDP and TCP and records every request it receives.
+    """
+
+    def __init__(self, deviceId='stub', alias='Stub', deviceType='IOT.SMARTPLUGSWITCH', host='127.0.0.1', port=0):
+        self.sysinfo = {'deviceId': deviceId, 'alias': alias, 'type': deviceType}
+        self.requests = []
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, port))
+        self.tcp.listen(5)
+        self.host, self.port = self.tcp.getsockname()
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, self.port))
+        self._stop = threading.Event()
+
+    def _answer(self, request):
+        self.requests.append(request)
+        if request == _SYSINFO:
+            return {'system': {'get_sysinfo': dict(self.sysinfo, err_code=0)}}
+        response = {}
+        for module, methods in request.items():
+            response[module] = dict((method, {'err_code': 0}) for method in methods)
+        return response
+
+    def _serve_tcp(self):
+        while not self._stop.is_set():
+            try:
+                conn, addr = self.tcp.accept()
+            except socket.error:
+                break
+            try:
+                size = struct.unpack('>I', _recv_exactly(conn, 4))[0]
+                payload = _encode(self._answer(_decode(_recv_exactly(conn, size))))
+                conn.sendall(struct.pack('>I', len(payload)) + payload)
+            finally:
+                conn.close()
+
+    def _serve_udp(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.udp.recvfrom(4096)
+            except socket.error:
+                break
+            if not data or self._stop.is_set():
+                break
+            try:
+                self.udp.sendto(_encode(self._answer(_decode(data))), addr)
+            except ValueError:
+                continue
+
+    def start(self):
+        for target in (self._serve_tcp, self._serve_udp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for sock in (self.tcp, self.udp):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
@@ -0,0 +1,231 @@
+'''
+In-memory timers and counters for the hot paths.
+
+Code times a stage with `with METRICS.timer('detect'):` and counts events
+with METRICS.count('frames_dropped').  Both do nothing until METRICS is
+enabled: timer() then hands back one shared no-op context manager, so the
+instrumentation left in the tracking loop costs a method call per stage.
+
+Once enabled, every timer keeps a rolling window of its latest durations
+(see RollingHistogram), and render() writes them, with the counters, in the
+Prometheus text format: serve() exposes that on /metrics, and summary() is
+a one-line version for the log.
+'''
+import logging
+import threading
+import time
+import sys
+import numpy as np
+
+is_py2 = sys.version[0] == '2'
+if is_py2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# monotonic where available
+_clock = getattr(time, 'perf_counter', time.time)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class RollingHistogram(object):
+    """ The last window observations, plus a running count and sum of all
+        of them.
+    """
+
+    def __init__(self, window=1024):
+        self.values = np.zeros(window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, quantiles=QUANTILES):
+        recent = self.values[:min(self.count, len(self.values))]
+        if not len(recent):
+            return [float('nan')] * len(quantiles)
+        return list(np.percentile(recent, [100.0 * q for q in quantiles]))
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.started = _clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.key, _clock() - self.started)
+        return False
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels))
+
+
+class Metrics(object):
+    """ A registry of timers (rolling histograms, in seconds) and counters,
+        each identified by a name and optional labels.  Disabled, it
+        records nothing.
+    """
+
+    def __init__(self, enabled=False, window=1024, prefix='rpotter_'):
+        self.enabled = enabled
+        self.window = window
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def enable(self, on=True):
+        self.enabled = on
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, _key(name, labels))
+
+    def observe(self, name, seconds, **labels):
+        if self.enabled:
+            self._observe(_key(name, labels), seconds)
+
+    def _observe(self, key, seconds):
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = RollingHistogram(self.window)
+            histogram.observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def snapshot(self):
+        """ {(name, labels): value} for counters and {(name, labels):
+            (count, sum, quantiles)} for timers.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            timers = dict((key, (h.count, h.sum, h.quantiles())) for key, h in self.histograms.items())
+        return counters, timers
+
+    def render(self):
+        """ Everything recorded, in the Prometheus text exposition format;
+            timers are summaries over their rolling window.
+        """
+        counters, timers = self.snapshot()
+        lines = []
+        for name in sorted(set(name for name, labels in counters)):
+            metric = self.prefix + name + '_total'
+            lines.append('# TYPE {} counter'.format(metric))
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append('{} {}'.format(_series(metric, labels), value))
+        for name in sorted(set(name for name, labels in timers)):
+            metric = self.prefix + name + '_seconds'
+            lines.append('# TYPE {} summary'.format(metric))
+            for (n, labels), (count, total, quantiles) in sorted(timers.items()):
+                if n != name:
+                    continue
+                for q, value in zip(QUANTILES, quantiles):
+                    lines.append('{} {:.6g}'.format(_series(metric, labels, [('quantile', q)]), value))
+                lines.append('{} {:.6g}'.format(_series(metric + '_sum', labels), total))
+                lines.append('{} {}'.format(_series(metric + '_count', labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ One line: median and p99 milliseconds per timer, then counters. """
+        counters, timers = self.snapshot()
+        parts = []
+        for (name, labels), (count, total, quantiles) in sorted(timers.items()):
+            parts.append('{} p50 {:.2f}ms p99 {:.2f}ms n={}'.format(
+                _series(name, labels), 1000 * quantiles[0], 1000 * quantiles[2], count))
+        for (name, labels), value in sorted(counters.items()):
+            parts.append('{}={}'.format(_series(name, labels), value))
+        return '; '.join(parts)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serve render() on http://host:port/metrics from a daemon thread. """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='Metrics')
+        thread.daemon = True
+        thread.start()
+        logging.info('Serving metrics on http://{}:{}/metrics'.format(host, self._server.server_address[1]))
+        return self._server
+
+    def report_every(self, interval, stop):
+        """ Log summary() every interval seconds until stop is set. """
+        def report():
+            while not stop.wait(interval):
+                logging.info('Metrics: {}'.format(self.summary()))
+        thread = threading.Thread(target=report, name='MetricsReport')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# the registry the pipeline and device code report to
+METRICS = Metrics()
@@ -0,0 +1,67 @@
+import math
+import os
+import time
+import numpy as np
+import cv2
+
+
+def trail_mask(frame):
+    """ A blank BGR image the size of frame, to draw trails onto. """
+    return np.zeros(frame.shape[:2] + (3,), np.uint8)
+
+
+def draw_trails(mask, good_new, good_old, movement_threshold=80):
+    """ Draw each tracked point's move onto mask, skipping jumps of
+        movement_threshold pixels or more.
+    """
+    for new, old in zip(good_new, good_old):
+        a, b = int(new[0]), int(new[1])
+        c, d = int(old[0]), int(old[1])
+        if math.hypot(a - c, b - d) < movement_threshold:
+            cv2.line(mask, (a, b), (c, d), (0, 255, 0), 2)
+
+
+def draw_tracks(frame, mask, good_new, good_old, color=(0, 0, 255), movement_threshold=80,
+                caption="Press ESC to close."):
+    """ Draw tracked points onto frame and their trails onto mask (see
+        trail_mask), and return the two combined.  A grayscale frame is
+        combined as BGR, leaving frame itself as it was.
+    """
+    draw_trails(mask, good_new, good_old, movement_threshold)
+    if frame.ndim == 2:
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    for i, new in enumerate(good_new):
+        a, b = int(new[0]), int(new[1])
+        cv2.circle(frame, (a, b), 5, color, -1)
+        cv2.putText(frame, str(i), (a, b), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255))
+    img = cv2.add(frame, mask)
+
+    if caption:
+        cv2.putText(img, caption, (5, 25),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
+    return img
+
+
+class DebugStream(object):
+    """ Writes an annotated frame to path at most once every interval
+        seconds, for watching a headless install without a display.  The
+        file is replaced atomically, so readers never see a partial image.
+    """
+
+    def __init__(self, path, interval=1.0, clock=time.time):
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.written = None
+        root, ext = os.path.splitext(path)
+        self._partial = root + '.partial' + (ext or '.jpg')
+
+    def due(self, now=None):
+        now = self.clock() if now is None else now
+        return self.written is None or now - self.written >= self.interval
+
+    def write(self, image):
+        """ Write image, usually what draw_tracks() returned. """
+        cv2.imwrite(self._partial, image)
+        os.rename(self._partial, self.path)
+        self.written = self.clock()
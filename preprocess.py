@@ -0,0 +1,138 @@
+import time
+import numpy as np
+import cv2
+
+from metrics import METRICS
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+STAGES = ('gray', 'equalize', 'blur', 'dilate', 'clahe')
+
+
+class Preprocessor(object):
+    """ Runs the grayscale -> equalizeHist -> GaussianBlur -> dilate -> CLAHE
+        chain into persistent buffers.
+
+        The dilation kernel and the CLAHE object are built once, and every
+        stage writes into one of two preallocated buffers, so no arrays are
+        allocated per frame once the first frame has been seen.
+
+        apply(crop, full_shape) preprocesses a crop of a full_shape image
+        with CLAHE tiles of about the size they have on the full image
+        (the grid is scaled to the crop, at least one tile each way), so a
+        region of interest gets the same local contrast as the full-frame
+        path, not 8x8 tiles a few pixels wide.  Tile boundaries still fall
+        differently, so results match the full frame only approximately.
+
+        Stages can be switched on and off individually with enable().  With
+        timed=True the cumulative time spent in each stage is kept in
+        timings (seconds) and counts (calls).
+
+        The array returned by apply() is owned by the preprocessor and is
+        overwritten by the next call; copy it if it has to outlive that.
+    """
+
+    def __init__(self, equalize=False, blur=True, dilate=True, clahe=True,
+                 blur_size=(9, 9), blur_sigma=1.5, dilation=(5, 5),
+                 clahe_clip=3.0, clahe_tiles=(8, 8), timed=False):
+        # equalizeHist is off by default: the original chain discarded its
+        # result, so enabling it changes what the detector sees.
+        self.enabled = {
+            'gray': True,
+            'equalize': equalize,
+            'blur': blur,
+            'dilate': dilate,
+            'clahe': clahe
+        }
+        self.blur_size = blur_size
+        self.blur_sigma = blur_sigma
+        self.kernel = np.ones(dilation, np.uint8)
+        self.clahe_clip = clahe_clip
+        self.clahe_tiles = tuple(clahe_tiles)
+        self.clahe = cv2.createCLAHE(clipLimit=clahe_clip, tileGridSize=self.clahe_tiles)
+        # one CLAHE object per tile grid crops have needed
+        self._clahes = {self.clahe_tiles: self.clahe}
+        self._current_clahe = self.clahe
+        self.timed = timed
+        self.timings = dict((stage, 0.0) for stage in STAGES)
+        self.counts = dict((stage, 0) for stage in STAGES)
+        self._buffers = None
+        self._stages = {
+            'gray': self._gray,
+            'equalize': self._equalize,
+            'blur': self._blur,
+            'dilate': self._dilate,
+            'clahe': self._clahe
+        }
+
+    def enable(self, stage, on=True):
+        if stage not in self.enabled:
+            raise KeyError('No known stage: {}'.format(stage))
+        self.enabled[stage] = on
+
+    def disable(self, stage):
+        self.enable(stage, False)
+
+    def reset_timings(self):
+        for stage in STAGES:
+            self.timings[stage] = 0.0
+            self.counts[stage] = 0
+
+    def _allocate(self, shape):
+        # Buffers are flat and only ever grow, so region-of-interest crops of
+        # varying size reuse the same memory as contiguous views.
+        size = shape[0] * shape[1]
+        if self._buffers is None or self._buffers[0].size < size:
+            self._buffers = (np.empty(size, np.uint8), np.empty(size, np.uint8))
+        return [buf[:size].reshape(shape) for buf in self._buffers]
+
+    def _gray(self, src, dst):
+        cv2.cvtColor(src, cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def _equalize(self, src, dst):
+        cv2.equalizeHist(src, dst=dst)
+
+    def _blur(self, src, dst):
+        cv2.GaussianBlur(src, self.blur_size, self.blur_sigma, dst=dst)
+
+    def _dilate(self, src, dst):
+        cv2.dilate(src, self.kernel, dst=dst, iterations=1)
+
+    def _clahe_for(self, shape, full_shape):
+        if full_shape is None:
+            return self.clahe
+        cols, rows = self.clahe_tiles
+        grid = (max(1, int(round(cols * shape[1] / float(full_shape[1])))),
+                max(1, int(round(rows * shape[0] / float(full_shape[0])))))
+        clahe = self._clahes.get(grid)
+        if clahe is None:
+            clahe = self._clahes[grid] = cv2.createCLAHE(clipLimit=self.clahe_clip, tileGridSize=grid)
+        return clahe
+
+    def _clahe(self, src, dst):
+        self._current_clahe.apply(src, dst=dst)
+
+    def apply(self, frame, full_shape=None):
+        with METRICS.timer('preprocess'):
+            buffers = self._allocate(frame.shape[:2])
+            self._current_clahe = self._clahe_for(frame.shape, full_shape)
+            src = frame
+            n = 0
+            for stage in STAGES:
+                if not self.enabled[stage]:
+                    continue
+                if stage == 'gray' and frame.ndim == 2:
+                    continue
+                dst = buffers[n % 2]
+                if self.timed:
+                    start = _clock()
+                    self._stages[stage](src, dst)
+                    self.timings[stage] += _clock() - start
+                    self.counts[stage] += 1
+                else:
+                    self._stages[stage](src, dst)
+                src = dst
+                n += 1
+            if src.ndim != 2:
+                raise ValueError('Preprocessor produced a {}-channel image; enable the gray stage'.format(src.shape[2]))
+            return src
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Template-based wand gesture recognition.
+
+Strokes are resampled to a fixed number of points, centred and scaled
+uniformly (in the spirit of the $1 recognizer, but without rotation
+invariance since direction is what tells spells apart), then compared
+against every template at once.
+
+Templates are stored in a compressed .npz file holding two arrays:
+names (T,) and points (T, n, 2) float32.
+
+Record templates with:
+
+    python recognizer.py record Lumos --strokes 5 --out gestures.npz
+    python recognizer.py list gestures.npz
+'''
+import argparse
+import logging
+import os
+import numpy as np
+from abc import ABCMeta, abstractmethod
+
+
+def resample(stroke, n):
+    """ Resample a (k, 2) stroke to n points spaced evenly along its path. """
+    stroke = np.asarray(stroke, np.float32).reshape(-1, 2)
+    steps = np.hypot(*np.diff(stroke, axis=0).T)
+    along = np.concatenate(([0.0], np.cumsum(steps)))
+    if along[-1] == 0:
+        return np.repeat(stroke[:1], n, axis=0)
+    targets = np.linspace(0.0, along[-1], n)
+    return np.stack((np.interp(targets, along, stroke[:, 0]),
+                     np.interp(targets, along, stroke[:, 1])), axis=1).astype(np.float32)
+
+
+def normalize(stroke, n):
+    """ Resample, move the centroid to the origin and scale uniformly so the
+        longer side of the bounding box is 1.
+    """
+    points = resample(stroke, n)
+    points -= points.mean(axis=0)
+    size = (points.max(axis=0) - points.min(axis=0)).max()
+    if size > 0:
+        points /= size
+    return points
+
+
+class Recognizer:
+    """ Turns a completed stroke into a spell name.
+
+        recognize() takes a (k, 2) array of positions and returns
+        (name, score), with name None when nothing matched well enough.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def recognize(self, stroke):
+        pass
+
+
+class TemplateRecognizer(Recognizer):
+    """ Nearest-template matching over normalised point clouds.  The score
+        is 1 for an exact match and falls to 0 at the largest possible
+        average distance; strokes scoring below threshold are rejected.
+    """
+
+    def __init__(self, names=None, points=None, n=32, threshold=0.8, min_length=20):
+        self.n = n
+        self.threshold = threshold
+        self.min_length = min_length
+        self.names = list(names or [])
+        if points is None:
+            points = np.empty((0, n, 2), np.float32)
+        self.points = np.asarray(points, np.float32).reshape(-1, n, 2)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        points = data['points']
+        return cls([str(name) for name in data['names']], points, n=points.shape[1], **kwargs)
+
+    def save(self, path):
+        # np.savez_compressed appends .npz to names without it
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, names=np.array(self.names), points=self.points)
+
+    def add(self, name, stroke):
+        self.names.append(name)
+        self.points = np.concatenate((self.points, normalize(stroke, self.n)[None]))
+
+    def recognize(self, stroke):
+        stroke = np.asarray(stroke, np.float32).reshape(-1, 2)
+        if not len(self.names) or len(stroke) < 2:
+            return None, 0.0
+        if np.hypot(*np.diff(stroke, axis=0).T).sum() < self.min_length:
+            return None, 0.0
+        candidate = normalize(stroke, self.n)
+        distances = np.sqrt(((self.points - candidate) ** 2).sum(axis=2)).mean(axis=1)
+        best = int(np.argmin(distances))
+        score = float(1.0 - distances[best] / (0.5 * np.sqrt(2.0)))
+        if score < self.threshold:
+            return None, score
+        return self.names[best], score
+
+
+class StrokeCollector(object):
+    """ Accumulates per-track positions and cuts them into strokes.
+
+        add() takes the tracked points for one frame; a track's stroke is
+        complete once the point has stayed within still pixels for
+        idle_frames frames, or when the buffer of max_points fills.
+        Positions live in one preallocated (max_tracks, max_points, 2)
+        array.
+    """
+
+    def __init__(self, max_tracks=10, max_points=128, min_points=8, idle_frames=5, still=2.0):
+        self.max_tracks = max_tracks
+        self.min_points = min_points
+        self.idle_frames = idle_frames
+        self.still = still
+        self.points = np.zeros((max_tracks, max_points, 2), np.float32)
+        self.lengths = np.zeros(max_tracks, np.int32)
+        self.idle = np.zeros(max_tracks, np.int32)
+        self._tracks = np.arange(max_tracks)
+
+    def reset(self):
+        self.lengths[:] = 0
+        self.idle[:] = 0
+
+    def add(self, good_new):
+        """ Record one frame of points (k, 2) and return a list of
+            (track, stroke) for strokes completed by it.
+        """
+        n = min(len(good_new), self.max_tracks)
+        good_new = np.asarray(good_new, np.float32).reshape(-1, 2)[:n]
+        tracks = self._tracks[:n]
+        lengths = self.lengths[:n]
+        last = self.points[tracks, np.maximum(lengths - 1, 0)]
+        moved = np.hypot(*(good_new - last).T) > self.still
+        moving = moved | (lengths == 0)
+        self.idle[:n] = np.where(moving, 0, self.idle[:n] + 1)
+        record = tracks[moving & (lengths < self.points.shape[1])]
+        self.points[record, self.lengths[record]] = good_new[record]
+        self.lengths[record] += 1
+        # tracks beyond the points seen this frame were lost
+        self.lengths[n:] = 0
+        self.idle[n:] = 0
+        done = tracks[((self.idle[:n] >= self.idle_frames) |
+                       (self.lengths[:n] >= self.points.shape[1])) &
+                      (self.lengths[:n] > 0)]
+        strokes = []
+        for track in done:
+            if self.lengths[track] >= self.min_points:
+                strokes.append((int(track), self.points[track, :self.lengths[track]].copy()))
+            self.lengths[track] = 0
+            self.idle[track] = 0
+        return strokes
+
+
+def record(name, strokes, out, source=0, n=32):
+    """ Track the wand from a camera (or video file) and save the next
+        strokes gestures as templates called name, adding to out.
+    """
+    import cv2
+    from preprocess import Preprocessor
+    from detection import HoughDetector, PyramidDetector
+    from tracker import WandTracker
+
+    lk_params = dict(winSize=(15, 15), maxLevel=2,
+                     criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+    templates = TemplateRecognizer.load(out) if os.path.exists(out) else TemplateRecognizer(n=n)
+    tracker = WandTracker(Preprocessor(), PyramidDetector(HoughDetector()), lk_params, interval=None)
+    collector = StrokeCollector(max_tracks=1)
+    cam = cv2.VideoCapture(source)
+    recorded = 0
+    try:
+        while recorded < strokes:
+            rval, frame = cam.read()
+            if not rval:
+                break
+            cv2.flip(frame, 1, frame)
+            good_new, good_old = tracker.update(frame)
+            if tracker.redetected:
+                collector.reset()
+                continue
+            for track, stroke in collector.add(good_new):
+                templates.add(name, stroke)
+                recorded += 1
+                logging.info("Recorded {} stroke {}/{} ({} points)".format(name, recorded, strokes, len(stroke)))
+    finally:
+        cam.release()
+    templates.save(out)
+    return recorded
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Record and inspect wand gesture templates.')
+    commands = parser.add_subparsers(dest='command')
+    rec = commands.add_parser('record', help='record strokes as templates for a spell')
+    rec.add_argument('name')
+    rec.add_argument('--strokes', type=int, default=5)
+    rec.add_argument('--out', default='gestures.npz')
+    rec.add_argument('--source', default='0', help='camera number or video file')
+    show = commands.add_parser('list', help='list the templates in a file')
+    show.add_argument('path')
+    args = parser.parse_args()
+    if args.command == 'record':
+        source = int(args.source) if args.source.lstrip('-').isdigit() else args.source
+        record(args.name, args.strokes, args.out, source)
+    elif args.command == 'list':
+        templates = TemplateRecognizer.load(args.path)
+        for name in sorted(set(templates.names)):
+            print('{}: {}'.format(name, templates.names.count(name)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import os
+import time
+import numpy as np
+import cv2
+
+
+def _pace(capture):
+    """ Sleep until capture's next frame is due at capture.fps frames per
+        second (if set); capture._next holds when that is.
+    """
+    if not capture.fps:
+        return
+    now = time.time()
+    if capture._next is not None and now < capture._next:
+        time.sleep(capture._next - now)
+        now = capture._next
+    capture._next = now + 1.0 / capture.fps
+
+
+class ReplayCapture(object):
+    """ Stands in for cv2.VideoCapture, reading recorded frames instead of a
+        camera.
+
+        path is either a video file cv2 can decode or a .npy stack of frames
+        shaped (n, height, width[, 3]), which is memory mapped rather than
+        loaded.  With loop=True playback restarts at the end; with fps set,
+        read() paces itself like a live camera instead of returning frames
+        as fast as they are asked for.  Once a recording that doesn't
+        loop has run out, ended is True.
+    """
+
+    def __init__(self, path, loop=False, fps=None):
+        self.path = path
+        self.loop = loop
+        self.fps = fps
+        self.position = 0
+        self.ended = False
+        self._next = None
+        self._stack = None
+        self._video = None
+        if os.path.splitext(path)[1].lower() == '.npy':
+            self._stack = np.load(path, mmap_mode='r')
+        else:
+            self._video = cv2.VideoCapture(path)
+
+    def isOpened(self):
+        if self._stack is not None:
+            return True
+        return self._video is not None and self._video.isOpened()
+
+    def __len__(self):
+        if self._stack is not None:
+            return len(self._stack)
+        return int(self._video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    def _read_stack(self, image):
+        if self.position >= len(self._stack):
+            if not self.loop or not len(self._stack):
+                self.ended = True
+                return False, None
+            self.position = 0
+        frame = self._stack[self.position]
+        self.position += 1
+        if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+            np.copyto(image, frame)
+            return True, image
+        return True, np.array(frame)
+
+    def _read_video(self, image):
+        rval, frame = self._video.read(image) if image is not None else self._video.read()
+        if not rval and self.loop and self.position:
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.position = 0
+            rval, frame = self._video.read(image) if image is not None else self._video.read()
+        if rval:
+            self.position += 1
+        else:
+            self.ended = True
+        return rval, frame
+
+    def read(self, image=None):
+        _pace(self)
+        if self._stack is not None:
+            return self._read_stack(image)
+        return self._read_video(image)
+
+    def get(self, prop):
+        if self._video is not None:
+            return self._video.get(prop)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self._stack.shape[2]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self._stack.shape[1]
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self._stack)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps or 0
+        return 0
+
+    def set(self, prop, value):
+        # recordings have a fixed size; accept and ignore camera settings
+        return False
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+        self._stack = None
+
+
+def save_stack(source, path, frames):
+    """ Record frames from a camera or video source into a .npy stack. """
+    cam = cv2.VideoCapture(source)
+    stack = None
+    count = 0
+    try:
+        while count < frames:
+            rval, frame = cam.read()
+            if not rval:
+                break
+            if stack is None:
+                stack = np.lib.format.open_memmap(path, mode='w+', dtype=frame.dtype,
+                                                  shape=(frames,) + frame.shape)
+            stack[count] = frame
+            count += 1
+    finally:
+        cam.release()
+    if stack is not None:
+        stack.flush()
+        if count < frames:
+            recorded = np.array(stack[:count])
+            del stack
+            np.save(path, recorded)
+    return count
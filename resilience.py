@@ -0,0 +1,141 @@
+'''
+Deadlines, retries and a circuit breaker for calls to the cloud endpoint.
+
+Every request TPLink and the devices make goes through the Resilience of
+the endpoint's ConnectionPool (see device.py), so they share one breaker:
+while the endpoint is down, calls fail at once with CircuitOpen instead of
+each waiting for its own timeout.
+'''
+import logging
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """ Opens after failures consecutive failures and then rejects calls for
+        reset_timeout seconds.  After that one trial call is let through
+        (half-open): success closes the breaker, failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failures=5, reset_timeout=30.0, clock=time.time):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.consecutive = 0
+        self.opened = None
+        self.trial = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened is None:
+            return self.CLOSED
+        if self.clock() - self.opened < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """ Raise CircuitOpen unless a call may go ahead now. """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return
+            self.rejected += 1
+            raise CircuitOpen('Circuit open for another {:.1f}s'.format(
+                max(self.reset_timeout - (self.clock() - self.opened), 0)))
+
+    def success(self):
+        with self._lock:
+            self.consecutive = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.trial or self.consecutive >= self.failures:
+                if self.opened is None or self.trial:
+                    logging.warning('Circuit opened after {} failures'.format(self.consecutive))
+                self.opened = self.clock()
+            self.trial = False
+
+
+class Resilience(object):
+    """ Runs attempt(timeout) within deadline seconds.
+
+        Each attempt gets the time left as its timeout.  Idempotent calls
+        that fail with one of retry_on are tried again up to retries times,
+        waiting backoff, 2 * backoff, ... (at most max_backoff) in between,
+        as long as the wait still fits before the deadline.  Other calls are
+        tried once.  Every attempt first asks the breaker, and reports its
+        outcome to it: any exception counts as a failure.
+    """
+
+    def __init__(self, deadline=10.0, retries=2, backoff=0.3, max_backoff=2.0, breaker=None,
+                 retry_on=(IOError,), clock=time.time, sleep=time.sleep):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker(clock=clock)
+        self.retry_on = retry_on
+        self.clock = clock
+        self.sleep = sleep
+        self.attempts = 0
+        self.retried = 0
+
+    def call(self, attempt, idempotent=False, deadline=None):
+        until = self.clock() + (self.deadline if deadline is None else deadline)
+        retries = self.retries if idempotent else 0
+        tried = 0
+        while True:
+            remaining = until - self.clock()
+            if remaining <= 0:
+                raise DeadlineExceeded('No answer within {}s'.format(self.deadline if deadline is None else deadline))
+            self.breaker.allow()
+            self.attempts += 1
+            try:
+                result = attempt(remaining)
+            except self.retry_on as e:
+                self.breaker.failure()
+                wait = min(self.backoff * (2 ** tried), self.max_backoff)
+                if tried >= retries or self.clock() + wait >= until:
+                    raise
+                tried += 1
+                self.retried += 1
+                logging.info('Retrying in {:.2f}s after: {}'.format(wait, e))
+                self.sleep(wait)
+                continue
+            except Exception:
+                # not worth a retry, but still a failed call (and it must
+                # end a half-open trial, or the breaker would stay shut)
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            return result
+
+    def stats(self):
+        return {
+            'attempts': self.attempts,
+            'retried': self.retried,
+            'breaker': self.breaker.state,
+            'rejected': self.breaker.rejected
+        }
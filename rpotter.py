@@ -17,61 +17,44 @@ Copyright (c) 2016 Sean O'Brien.  Permission is hereby granted, free of charge,
 The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
-import io
-import numpy as np
+import os
 import argparse
-import cv2
-from cv2 import *
 import threading
-import sys
-import math
+import signal
 import time
-
-import warnings
-import tplink
-is_py2 = sys.version[0] == '2'
-if is_py2: import Queue as queue
-else: import queue as queue
-from device import DeviceFactory, Bulb
-from collections import defaultdict
 import logging
+import warnings
+from collections import OrderedDict
 
-logging.basicConfig(level=logging.INFO)
-warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
-
-_SUPPORTS_PI_LIBS = False
-
-try:
-    import pigpio
-    import picamera
-    _SUPPORTS_PI_LIBS = True
-except:
-    print "Can not import Raspberry Pi Libraries"
-if _SUPPORTS_PI_LIBS:
-    GPIOS=32
-    MODES=["INPUT", "OUTPUT", "ALT5", "ALT4", "ALT0", "ALT1", "ALT2", "ALT3"]
-
-    pi = pigpio.pi()
-
-    #NOTE pins use BCM numbering in code.  I reference BOARD numbers in my articles - sorry for the confusion!
-
-    #pin for Powerswitch (Lumos,Nox)
-    switch_pin = 23
-    pi.set_mode(switch_pin,pigpio.OUTPUT)
-
-    #pin for Particle (Nox)
-    nox_pin = 24
-    pi.set_mode(nox_pin,pigpio.OUTPUT)
-
-    #pin for Particle (Incendio)
-    incendio_pin = 22
-    pi.set_mode(incendio_pin,pigpio.OUTPUT)
-
-    #pin for Trinket (Colovario)
-    trinket_pin = 12
-    pi.set_mode(trinket_pin,pigpio.OUTPUT)
+import numpy as np
+import cv2
 
-logging.info("Initializing point tracking")
+from capture import FrameGrabber
+from preprocess import Preprocessor
+from tracker import RoiTracker, WandTracker
+from detection import HoughDetector, BlobDetector, PyramidDetector
+from gestures import GestureClassifier, Cooldown
+from recognizer import TemplateRecognizer, StrokeCollector
+from overlay import draw_tracks, draw_trails, trail_mask, DebugStream
+from camera import open_camera, BACKENDS
+from metrics import METRICS
+
+# tplink, device, dispatch and effects pull in requests and yaml; they are
+# imported by the startup phases that need them, off the main thread.
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#NOTE pins use BCM numbering in code.  I reference BOARD numbers in my articles - sorry for the confusion!
+
+#pin for Powerswitch (Lumos,Nox)
+switch_pin = 23
+#pin for Particle (Nox)
+nox_pin = 24
+#pin for Particle (Incendio)
+incendio_pin = 22
+#pin for Trinket (Colovario)
+trinket_pin = 12
+OUTPUT_PINS = (switch_pin, nox_pin, incendio_pin, trinket_pin)
 
 # Parameters
 lk_params = dict( winSize  = (15,15),
@@ -81,292 +64,404 @@ blur_params = (4,4)
 dilation_params = (5, 5)
 movment_threshold = 80
 
-logging.info("START switch_pin ON for pre-video test")
-if _SUPPORTS_PI_LIBS:
-    pi.write(nox_pin,0)
-    pi.write(incendio_pin,0)
-    pi.write(switch_pin,1)
-
-# start capturing
-cv2.namedWindow("Raspberry Potter")
-if _SUPPORTS_PI_LIBS:
-    CAM_NUMBER = -1
-else:
-    CAM_NUMBER = 0
-cam = cv2.VideoCapture(CAM_NUMBER)
-if _SUPPORTS_PI_LIBS:
-    cam.set(3, 640)
-    cam.set(4, 480)
-else:
-    cam.set(3, 1024)
-    cam.set(4, 768)
-
-
-class TPLinkWorker(threading.Thread):
-    # Based on https://eli.thegreenplace.net/2011/12/27/python-threads-communication-and-stopping
-    """ A worker thread that takes directory names from a queue, finds all
-        files in them recursively and reports the result.
-
-        Input is done by placing directory names (as strings) into the
-        Queue passed in dir_q.
-
-        Output is done by placing tuples into the Queue passed in result_q.
-        Each tuple is (thread name, dirname, [list of files]).
-
-        Ask the thread to stop by calling its join() method.
+# Track inside padded windows around the wand points rather than over the
+# whole frame; set roi_tracking = False to process full frames.
+roi_tracking = True
+roi_padding = 48
+
+# Search for wand tips on an image downscaled by detection_scale first, then
+# refine at full resolution. --detector blob uses BlobDetector (threshold +
+# connected components) instead of a Hough transform.
+# TODO: trained image recognition
+detection_scale = 2
+
+# Look for new wand points when fewer than redetect_min_points are tracked,
+# or every redetect_interval seconds.
+redetect_interval = 3
+redetect_min_points = 1
+
+# look for basic movements
+# Earlier gestures win if several complete on the same frame.
+GESTURES = [
+    ("Lumos", ("right", "up")),
+    ("Nox", ("right", "down")),
+    ("Colovaria", ("left", "down")),
+    # ("Incendio", ("left", "up")),
+]
+
+# Trained gestures: templates recorded with `python recognizer.py record`.
+# Used alongside the basic movements when the file exists.
+gesture_templates = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gestures.npz")
+
+# Seconds before the same spell can be cast again; tracking keeps running.
+spell_cooldown = 3.1
+SPELL_COOLDOWNS = {
+    "Colovaria": 5,
+}
+
+# one pending state per device: Lumos, Nox, Lumos in quick succession only
+# sends the last one, and casting never blocks the tracking loop.  Commands
+# for one device run in order; different devices run in parallel, and
+# Colovaria can't take the last free worker away from Lumos/Nox.
+dispatcher_workers = 4
+
+# Startup phases that run concurrently; tracking starts once the required
+# ones are done, while the cloud login and device list may still be loading.
+REQUIRED_PHASES = ("camera", "gpio", "dispatcher")
+
+
+def _pigpio():
+    try:
+        import pigpio
+        return pigpio
+    except ImportError:
+        return None
+
+
+def LogRecord(record):
+    for result in record.results:
+        if result.error is not None:
+            logging.error("{} {}: {}".format(record.label or record.key, result.device.alias, result.error))
+    logging.debug("{} queued {:.3f}s ran {:.3f}s".format(
+        record.label or record.key, record.started - record.enqueued, record.finished - record.started))
+
+
+class RaspberryPotter(object):
+    """ The wand tracker and everything it drives.
+
+        Nothing is opened on construction.  start() brings up the camera,
+        the GPIO pins, the device dispatcher and the cloud session in
+        parallel, timing each phase (see timings), and returns once tracking
+        can begin; run() tracks until stop is set or ESC is pressed, and
+        close() releases everything that was started.
     """
 
-    def __init__(self, tasks_queue, result_queue):
-        super(TPLinkWorker, self).__init__()
-        self.tasks_queue = tasks_queue
-        self.result_queue = result_queue
-        self.stoprequest = threading.Event()
-        self.stopcolovaria = threading.Event()
+    def __init__(self, args):
+        self.args = args
+        self.stop = threading.Event()
+        # a stop event per effect that is queued or playing
+        self.effects = set()
+        self.effects_lock = threading.Lock()
+        self.timings = OrderedDict()
+        self.errors = {}
+        self.cam = None
+        self.grabber = None
+        self.pi = None
+        self.dispatcher = None
+        self.results = None
+        self.cloud = None
+        self.mask = None
+        self.color = (0, 0, 255)
+        self.debug_stream = DebugStream(args.debug_stream, args.debug_interval) if args.debug_stream else None
+
+        # only try to detect gesture on highly-rated points (below 10)
+        self.classifier = GestureClassifier(GESTURES, max_tracks=10)
+        self.recognizer = TemplateRecognizer.load(gesture_templates) if os.path.exists(gesture_templates) else None
+        self.strokes = StrokeCollector(max_tracks=10)
+        self.cooldown = Cooldown(default=spell_cooldown, durations=SPELL_COOLDOWNS)
+        if args.detector == 'blob':
+            base = BlobDetector(min_radius=2, max_radius=15)
+        else:
+            base = HoughDetector(dp=3, min_dist=50, param1=240, param2=8, min_radius=4, max_radius=15)
+        detector = PyramidDetector(base, scale=detection_scale)
+        prep = Preprocessor(dilation=dilation_params)
+        self.tracker = WandTracker(prep, detector, lk_params,
+                                   roi=RoiTracker(prep, lk_params, pad=roi_padding) if roi_tracking else None,
+                                   interval=redetect_interval, min_points=redetect_min_points)
+
+    # startup phases
+
+    def open_camera(self):
+        resolution = (640, 480) if _pigpio() else (1024, 768)
+        # headless there is nothing to draw on, so cameras that can deliver
+        # grayscale frames directly (the Y plane on the Pi) do
+        cam = open_camera(self.args.camera, resolution, gray=self.args.headless,
+                          replay=self.args.replay, loop=self.args.loop, fps=self.args.fps)
+        self.cam = cam
+        # the first read waits for the sensor to settle
+        cam.read()
+        self.grabber = FrameGrabber(cam)
+        self.grabber.start()
+
+    def init_gpio(self):
+        pigpio = _pigpio()
+        if pigpio is None:
+            logging.warning("Can not import Raspberry Pi Libraries")
+            return
+        pi = pigpio.pi()
+        if not pi.connected:
+            logging.warning("pigpio daemon not running; GPIO disabled")
+            return
+        for pin in OUTPUT_PINS:
+            pi.set_mode(pin, pigpio.OUTPUT)
+        logging.info("START switch_pin ON for pre-video test")
+        pi.write(nox_pin,0)
+        pi.write(incendio_pin,0)
+        pi.write(switch_pin,1)
+        self.pi = pi
+
+    def start_dispatcher(self):
+        from dispatch import Dispatcher, ResultSink
+        # a Record per spell cast, combining the commands the dispatcher ran
+        # for it; subscribe() for telemetry
+        self.results = ResultSink(maxlen=100)
+        self.results.subscribe(LogRecord)
+        self.dispatcher = Dispatcher(self.run_task, workers=dispatcher_workers, sink=self.results)
+        self.dispatcher.start()
+
+    def connect_cloud(self):
+        # log in and build the devices before the first spell needs them
+        import tplink
+        session = tplink.session()
+        session.devices()
+        self.cloud = session
+
+    def _phase(self, name, init):
+        started = _clock()
+        try:
+            init()
+        except Exception as e:
+            logging.error("{} failed to start: {}".format(name, e))
+            self.errors[name] = e
+        finally:
+            self.timings[name] = _clock() - started
+            logging.info("{} ready in {:.2f}s".format(name, self.timings[name]))
+
+    def start(self):
+        started = _clock()
+        phases = OrderedDict()
+        for name, init in (("camera", self.open_camera), ("gpio", self.init_gpio),
+                           ("dispatcher", self.start_dispatcher), ("cloud", self.connect_cloud)):
+            phase = threading.Thread(target=self._phase, args=(name, init), name="start-" + name)
+            phase.daemon = True
+            phase.start()
+            phases[name] = phase
+        for name in REQUIRED_PHASES:
+            phases[name].join()
+        for name in ("camera", "dispatcher"):
+            if name in self.errors:
+                raise self.errors[name]
+        if not self.args.headless:
+            cv2.namedWindow("Raspberry Potter")
+        if self.pi:
+            logging.info("START incendio_pin ON and set switch off if video is running")
+            self.pi.write(incendio_pin,1)
+            self.pi.write(switch_pin,0)
+        self.timings["ready"] = _clock() - started
+        logging.info("Startup: {}".format(", ".join(
+            "{} {:.2f}s".format(name, seconds) for name, seconds in self.timings.items())))
+
+    # spells
+
+    def run_task(self, key, task):
+        from dispatch import ALL_DEVICES, timed_state
+        import tplink
+        if callable(task):
+            return task()
+        session = tplink.session()
+        if key == ALL_DEVICES:
+            # hand the state on to every device's own lane
+            for device in session.devices():
+                self.dispatcher.submit(device.deviceId, task)
+            return ()
+        device = session.device(key)
+        if device is None:
+            raise KeyError("Unknown device: {}".format(key))
+        return [timed_state(device, task, session)]
+
+    def queue_colovaria(self, stop):
+        # runs on the ALL_DEVICES lane, so the effect takes the bulbs' lanes
+        # after the commands cast before it and ahead of those cast after
+        from device import Bulb
+        import tplink
+        if stop.is_set():
+            self.effect_done(stop)
+            return ()
+        bulbs = tplink.session().devices(Bulb)
+        self.dispatcher.submit("Colovaria", lambda: self.colovaria(bulbs, stop), long_running=True,
+                               lanes=[bulb.deviceId for bulb in bulbs])
+        return ()
+
+    def colovaria(self, bulbs, stop):
+        from effects import Effect, hue_sweep
+        import tplink
+        try:
+            if stop.is_set():
+                return ()
+            logging.info("Colovaria called")
+            effect = Effect(bulbs, hue_sweep(), session=tplink.session())
+            if not effect.run(stop):
+                logging.info("Colovaria stopped")
+            return effect.results
+        finally:
+            self.effect_done(stop)
+
+    def effect_done(self, stop):
+        with self.effects_lock:
+            self.effects.discard(stop)
+
+    def stop_effects(self):
+        with self.effects_lock:
+            for stop in self.effects:
+                stop.set()
+            self.effects.clear()
+
+    def spell(self, spell):
+        from dispatch import ALL_DEVICES
+        # clear all checks
+        self.classifier.reset()
+        self.strokes.reset()
+        # Invoke IoT (or any other) actions here
+        if self.mask is not None:
+            cv2.putText(self.mask, spell, (5, 25), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 0, 0))
+        if self.dispatcher is None:
+            self.start_dispatcher()
+        if (spell == "Colovaria"):
+            stop = threading.Event()
+            with self.effects_lock:
+                self.effects.add(stop)
+            self.dispatcher.submit("queue-Colovaria", lambda: self.queue_colovaria(stop),
+                                   lanes=[ALL_DEVICES], label=spell)
+        elif (spell == "Lumos"):
+            self.stop_effects()
+            self.dispatcher.submit(ALL_DEVICES, {"on_off": 1}, label=spell)
+        elif (spell == "Nox"):
+            self.stop_effects()
+            self.dispatcher.submit(ALL_DEVICES, {"on_off": 0}, label=spell)
+        else:
+            logging.error("Spell not found: {}".format(spell))
+            return False
+        METRICS.count('spells', spell=spell)
+        logging.info("CAST: {}".format(spell))
+        return True
+
+    # tracking
 
     def run(self):
-        # As long as we weren't asked to stop, try to take new tasks from the
-        # queue. The tasks are taken with a blocking 'get', so no CPU
-        # cycles are wasted while waiting.
-        # Also, 'get' is given a timeout, so stoprequest is always checked,
-        # even if there's nothing in the queue.
-        logging.info("Starting Worker")
-        while not self.stoprequest.isSet():
+        headless = self.args.headless
+        # trails are kept for the window and the debug stream alike
+        annotate = not headless or self.debug_stream is not None
+        tracker = self.tracker
+        while not self.stop.is_set():
             try:
-                spell = self.tasks_queue.get(True, 3)
-                self.result_queue.put(spell())
-                self.tasks_queue.task_done()
-                logging.info(self.result_queue.get(True,3))
-            except queue.Empty:
+                rval, frame = self.grabber.read()
+                if not rval:
+                    if self.grabber.ended:
+                        # a replay without --loop has run out
+                        break
+                    continue
+                started = _clock()
+                # Create a mask image for drawing purposes
+                if self.mask is None and annotate:
+                    self.mask = trail_mask(frame)
+                image = frame
+                snapshot = self.debug_stream is not None and self.debug_stream.due()
+                good_new, good_old = tracker.update(frame)
+                if tracker.redetected:
+                    # per-frame logging costs SD card writes on the Pi
+                    logging.debug("finding...")
+                    if self.mask is not None:
+                        self.mask[...] = 0
+                    self.classifier.reset()
+                    self.strokes.reset()
+                elif tracker.p0 is not None:
+                    with METRICS.timer('gesture'):
+                        spell = self.classifier.classify(good_new, good_old)
+                        if self.recognizer:
+                            for track, stroke in self.strokes.add(good_new):
+                                name, score = self.recognizer.recognize(stroke)
+                                logging.debug("Stroke {}: {} ({:.2f})".format(track, name, score))
+                                spell = spell or name
+                    if spell and self.cooldown.trigger(spell):
+                        with METRICS.timer('spell'):
+                            self.spell(spell)
+                    elif spell:
+                        logging.debug("Cooling down: {}".format(spell))
+                    # draw the tracks, combining them with the frame only
+                    # when it will be shown or written
+                    if not headless or snapshot:
+                        image = draw_tracks(frame, self.mask, good_new, good_old, self.color, movment_threshold,
+                                            caption=None if headless else "Press ESC to close.")
+                    elif annotate:
+                        draw_trails(self.mask, good_new, good_old, movment_threshold)
+                METRICS.observe('frame', _clock() - started)
+                if snapshot:
+                    self.debug_stream.write(image)
+                if not headless:
+                    cv2.imshow("Raspberry Potter", image)
+            except IndexError:
+                logging.warning("Index error - Tracking")
+            except Exception as e:
+                logging.error("Tracking Error: {}".format(e))
+            if headless:
                 continue
-
-    def join(self, timeout=None):
-        self.stoprequest.set()
-        super(TPLinkWorker, self).join(timeout)
-
-    def _lumos(self):
-        logging.info("Lumos called")
-        tplink.allOn()
-
-    def _nox(self):
-        logging.info("Nox called")
-        tplink.allOff()
-
-    def _colovaria(self):
-        logging.info("Colovaria called")
-        self.stopcolovaria.clear()
-        l = tplink.TPLink()
-        logging.info(l.login())
-        factory = DeviceFactory(l.endpoint)
-        devices = defaultdict(list)
-        for device in l.getDeviceList()['result']['deviceList']:
-            logging.info('{}: {}'.format(device['alias'], device['deviceId']))
-            device = factory.buildDevice(device)
-            devices[device.__class__].append(device)
-            device.token = l.token
-            # logging.info(device.on())
-            # time.sleep(.5)
-            # logging.info(device.off())
-        for bulb in devices[Bulb]:
-            logging.info(bulb.on())
-            logging.info(bulb.color())
-            logging.info(bulb.saturation(100))
-            for hue in range(361):
-                if self.stopcolovaria.isSet():
-                    break
-                logging.info(bulb.hue(hue))
-                time.sleep(20 / 1000.0)
-            logging.info(bulb.white())
-            if self.stopcolovaria.isSet():
+            key = cv2.waitKey(1)
+            if key in [27, ord('Q'), ord('q')]:  # exit on ESC
                 break
-        self.stopcolovaria.clear()
-
-
-TASKS = queue.Queue(maxsize=10)
-RESULTS = queue.Queue(maxsize=20)
-WORKER = None
-
-
-def startWorker():
-    global WORKER
-    WORKER = TPLinkWorker(TASKS,RESULTS)
-    WORKER.start()
-
-
-def Spell(spell):
-    # clear all checks
-    ig = [[0] for x in range(15)]
-    # Invoke IoT (or any other) actions here
-    cv2.putText(mask, spell, (5, 25), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 0, 0))
-    if not WORKER or not WORKER.isAlive():
-        startWorker()
-    if (spell == "Colovaria"):
-        TASKS.put(WORKER._colovaria, True, 1)
-    elif (spell == "Lumos"):
-        WORKER.stopcolovaria.set()
-        TASKS.put(WORKER._lumos, True, 1)
-    elif (spell == "Nox"):
-        WORKER.stopcolovaria.set()
-        TASKS.put(WORKER._nox, True, 1)
-    else:
-        logging.error("Spell not found: {}".format(spell))
-        return False
-    logging.info("CAST: {}".format(spell))
-    return True
-
-
-def IsGesture(a, b, c, d, i):
-    logging.debug("point: {}".format(i))
-    # look for basic movements - TODO: trained gestures
-    if ((a < (c - 5)) & (abs(b - d) < 2)):
-        ig[i].append("left")
-    elif ((c < (a - 5)) & (abs(b - d) < 2)):
-        ig[i].append("right")
-    elif ((b < (d - 5)) & (abs(a - c) < 5)):
-        ig[i].append("up")
-    elif ((d < (b - 5)) & (abs(a - c) < 5)):
-        ig[i].append("down")
-    # check for gesture patterns in array
-    astr = ''.join(map(str, ig[i]))
-    logging.debug(astr)
-    if "rightup" in astr:
-        return Spell("Lumos")
-    elif "rightdown" in astr:
-        return Spell("Nox")
-    elif "leftdown" in astr:
-        return Spell("Colovaria")
-    # elif "leftup" in astr:
-    #     return Spell("Incendio")
-    return False
-
-
-def FindWand():
-    global rval, old_frame, old_gray, p0, mask, color, ig, img, frame
-    try:
-        rval, old_frame = cam.read()
-        cv2.flip(old_frame, 1, old_frame)
-        old_gray = cv2.cvtColor(old_frame, cv2.COLOR_BGR2GRAY)
-        equalizeHist(old_gray)
-        old_gray = GaussianBlur(old_gray, (9, 9), 1.5)
-        dilate_kernel = np.ones(dilation_params, np.uint8)
-        old_gray = cv2.dilate(old_gray, dilate_kernel, iterations=1)
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-        old_gray = clahe.apply(old_gray)
-        # TODO: trained image recognition
-        p0 = cv2.HoughCircles(old_gray, cv2.HOUGH_GRADIENT, 3, 50, param1=240, param2=8, minRadius=4, maxRadius=15)
-        if p0 is not None:
-            p0.shape = (p0.shape[1], 1, p0.shape[2])
-            p0 = p0[:, :, 0:2]
-            mask = np.zeros_like(old_frame)
-            ig = [[0] for x in range(20)]
-        logging.info("finding...")
-        threading.Timer(3, FindWand).start()
-    except:
-        e = sys.exc_info()[1]
-        logging.error("Error: {}".format(e))
-        if WORKER.isAlive():
-            WORKER.stoprequest.set()
-            WORKER.join()
-        exit()
-
-
-def TrackWand():
-    global rval, old_frame, old_gray, p0, mask, color, ig, img, frame
+
+    def close(self):
+        if self.dispatcher is not None:
+            # stop any effect so the queued commands drain promptly
+            self.stop_effects()
+            self.dispatcher.close(drain=True, timeout=10)
+            logging.info("Device commands: {}".format(self.dispatcher.stats()))
+        if self.grabber:
+            if self.grabber.is_alive():
+                self.grabber.join()
+            logging.info("Frames: {}".format(self.grabber.stats()))
+        if not self.args.headless:
+            cv2.destroyAllWindows()
+        if self.cam is not None:
+            self.cam.release()
+        if self.pi is not None:
+            self.pi.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Raspberry Potter")
+    parser.add_argument("--camera", choices=BACKENDS, default="auto",
+                        help="camera backend; auto uses picamera on the Pi and OpenCV elsewhere")
+    parser.add_argument("--replay", help="read frames from a video file or .npy frame stack instead of the camera")
+    parser.add_argument("--loop", action="store_true", help="restart the replay when it ends")
+    parser.add_argument("--fps", type=float, help="pace the replay or synthetic camera like a camera running at this rate")
+    parser.add_argument("--detector", choices=("hough", "blob"), default="hough",
+                        help="how to find wand tips: a Hough transform, or thresholded blobs (cheaper)")
+    parser.add_argument("--headless", action="store_true", help="no window or overlay; stop with SIGTERM/SIGINT")
+    parser.add_argument("--debug-stream", metavar="PATH", help="write an annotated frame to PATH now and then")
+    parser.add_argument("--debug-interval", type=float, default=2.0, help="seconds between debug stream frames")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus-style metrics on this local port")
+    parser.add_argument("--metrics-interval", type=float, help="log a metrics summary every this many seconds")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    if hasattr(np, "VisibleDeprecationWarning"):
+        warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
+    args = parse_args(argv)
+    app = RaspberryPotter(args)
+    # instrumentation stays off (and nearly free) unless asked for
+    if args.metrics_port or args.metrics_interval:
+        METRICS.enable()
+    if args.metrics_port:
+        METRICS.serve(args.metrics_port)
+    if args.metrics_interval:
+        METRICS.report_every(args.metrics_interval, app.stop)
+
+    def Stop(signum, frame):
+        logging.info("Stopping on signal {}".format(signum))
+        app.stop.set()
+
+    signal.signal(signal.SIGTERM, Stop)
+    signal.signal(signal.SIGINT, Stop)
+    logging.info("Initializing point tracking")
     try:
-        color = (0, 0, 255)
-        rval, old_frame = cam.read()
-        cv2.flip(old_frame, 1, old_frame)
-        old_gray = cv2.cvtColor(old_frame, cv2.COLOR_BGR2GRAY)
-        equalizeHist(old_gray)
-        old_gray = GaussianBlur(old_gray, (9, 9), 1.5)
-        dilate_kernel = np.ones(dilation_params, np.uint8)
-        old_gray = cv2.dilate(old_gray, dilate_kernel, iterations=1)
-        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-        old_gray = clahe.apply(old_gray)
-
-        # Take first frame and find circles in it
-        p0 = cv2.HoughCircles(old_gray, cv2.HOUGH_GRADIENT, 3, 50, param1=240, param2=8, minRadius=4, maxRadius=15)
-        if p0 is not None:
-            p0.shape = (p0.shape[1], 1, p0.shape[2])
-            p0 = p0[:, :, 0:2]
-            mask = np.zeros_like(old_frame)
-    except:
-        logging.warning("No points found")
-    # Create a mask image for drawing purposes
-
-    while True:
-        try:
-            rval, frame = cam.read()
-            cv2.flip(frame, 1, frame)
-            if p0 is not None:
-                frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                equalizeHist(frame_gray)
-                frame_gray = GaussianBlur(frame_gray, (9, 9), 1.5)
-                dilate_kernel = np.ones(dilation_params, np.uint8)
-                frame_gray = cv2.dilate(frame_gray, dilate_kernel, iterations=1)
-                frame_clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-                frame_gray = frame_clahe.apply(frame_gray)
-
-                # calculate optical flow
-                p1, st, err = cv2.calcOpticalFlowPyrLK(old_gray, frame_gray, p0, None, **lk_params)
-
-                # Select good points
-                good_new = p1[st == 1]
-                good_old = p0[st == 1]
-
-                # draw the tracks
-                for i, (new, old) in enumerate(zip(good_new, good_old)):
-                    a, b = new.ravel()
-                    c, d = old.ravel()
-                    # only try to detect gesture on highly-rated points (below 10)
-                    if (i < 10):
-                        if IsGesture(a, b, c, d, i): time.sleep(3.1)
-                    dist = math.hypot(a - c, b - d)
-                    if (dist < movment_threshold):
-                        cv2.line(mask, (a, b), (c, d), (0, 255, 0), 2)
-                    cv2.circle(frame, (a, b), 5, color, -1)
-                    cv2.putText(frame, str(i), (a, b), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255))
-                img = cv2.add(frame, mask)
-
-                cv2.putText(img, "Press ESC to close.", (5, 25),
-                            cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255))
-            cv2.imshow("Raspberry Potter", frame)
-
-            # get next frame
-            rval, frame = cam.read()
-
-            # Now update the previous frame and previous points
-            old_gray = frame_gray.copy()
-            p0 = good_new.reshape(-1, 1, 2)
-        except IndexError:
-            logging.warning("Index error - Tracking")
-        except KeyboardInterrupt:
-            cleanupAll()
-            exit(0)
-        except:
-            e = sys.exc_info()[0]
-            logging.error("Tracking Error: {}".format(e))
-        key = cv2.waitKey(20)
-        if key in [27, ord('Q'), ord('q')]:  # exit on ESC
-            cleanupAll()
-            exit(0)
-            break
-
-def cleanupAll():
-    if WORKER.isAlive():
-        WORKER.stoprequest.set()
-        WORKER.join()
-    cv2.destroyAllWindows()
-    cam.release()
-
-
-try:
-    startWorker()
-    FindWand()
-    logging.info("START incendio_pin ON and set switch off if video is running")
-    if _SUPPORTS_PI_LIBS:
-        pi.write(incendio_pin,1)
-        pi.write(switch_pin,0)
-    TrackWand()
-
-finally:
-    cleanupAll();
+        app.start()
+        app.run()
+    finally:
+        app.close()
+        METRICS.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+import pytest
+
+import rpotter
+from camera import LUMOS, SyntheticCamera, _importable, open_camera
+from detection import BlobDetector, HoughDetector
+from replay import ReplayCapture
+
+
+def casts(camera, frames):
+    """ Spells the app's tracker and classifier see in frames from camera,
+        mirrored like FrameGrabber does, as (frame, spell) pairs.
+    """
+    app = rpotter.RaspberryPotter(rpotter.parse_args(['--headless']))
+    now = [0.0]
+    app.tracker.clock = lambda: now[0]
+    found = []
+    for i in range(frames):
+        now[0] = i / 30.0
+        rval, frame = camera.read()
+        assert rval
+        good_new, good_old = app.tracker.update(cv2.flip(frame, 1))
+        if app.tracker.redetected:
+            app.classifier.reset()
+        elif app.tracker.p0 is not None:
+            spell = app.classifier.classify(good_new, good_old)
+            if spell:
+                found.append((i, spell))
+                app.classifier.reset()
+    return found
+
+
+def test_gray_frames_are_single_channel():
+    camera = SyntheticCamera((640, 480), gray=True)
+    rval, frame = camera.read()
+    assert rval and frame.shape == (480, 640) and frame.dtype == np.uint8
+    # the tip is drawn white at start over background noise
+    assert frame[300, 400] == 255 and frame[0, 0] < 8
+    assert open_camera('synthetic', (320, 240), gray=True).read()[1].ndim == 2
+
+
+def test_importable_finds_installed_modules_only():
+    assert _importable('json') and not _importable('no_such_camera_module')
+
+
+def test_read_reuses_the_given_image():
+    camera = SyntheticCamera((320, 240), gray=True)
+    image = np.empty((240, 320), np.uint8)
+    assert camera.read(image)[1] is image
+
+
+@pytest.mark.parametrize('resolution', [(640, 480), (1024, 768)])
+def test_lumos_is_detected_in_gray_mode(resolution):
+    camera = SyntheticCamera(resolution, gray=True)
+    strokes = sum(frames for step, frames in LUMOS)
+    found = casts(camera, strokes)
+    assert [spell for i, spell in found] == ['Lumos']
+
+
+def test_run_stops_when_a_replay_ends(tmpdir):
+    path = str(tmpdir.join('frames.npy'))
+    camera = SyntheticCamera((320, 240), gray=True)
+    np.save(path, np.array([camera.read()[1] for i in range(5)]))
+    app = rpotter.RaspberryPotter(rpotter.parse_args(['--headless', '--replay', path]))
+    app.open_camera()
+    try:
+        app.run()
+        assert app.grabber.ended and isinstance(app.cam, ReplayCapture) and app.cam.ended
+        assert app.grabber.captured == 4
+    finally:
+        app.close()
+
+
+@pytest.mark.parametrize('name, detector', [('hough', HoughDetector), ('blob', BlobDetector)])
+def test_detector_is_chosen_by_flag(name, detector):
+    app = rpotter.RaspberryPotter(rpotter.parse_args(['--headless', '--detector', name]))
+    assert isinstance(app.tracker.detector.detector, detector)
@@ -0,0 +1,75 @@
+import pytest
+
+import tplink
+from cloudstub import StubCloud
+
+
+@pytest.fixture
+def cloud():
+    cloud = StubCloud().start()
+    yield cloud
+    cloud.stop()
+
+
+@pytest.fixture
+def session(cloud):
+    session = tplink.Session(tplink.TPLink(cloud.endpoint, 'uuid'), cache_file=None, local=False)
+    session.refresh()
+    return session
+
+
+def passthroughs(cloud):
+    return len([request for request in cloud.requests if request['method'] == 'passthrough'])
+
+
+def test_redundant_commands_are_skipped(cloud, session):
+    plug = session.device('stub-plug')
+    assert plug.set_state(on_off=1) is not None
+    assert plug.set_state(on_off=1) is None
+    assert (plug.skipped, passthroughs(cloud)) == (1, 1)
+    bulb = session.device('stub-bulb')
+    bulb.set_state(on_off=1, brightness=50)
+    bulb.set_state(on_off=1, brightness=20, transition_period=500)
+    # only the changed field goes out, with the transition
+    assert cloud.states['stub-bulb'] == {'on_off': 1, 'brightness': 20}
+    assert passthroughs(cloud) == 3
+
+
+def test_cached_state_expires(cloud, session):
+    plug = session.device('stub-plug')
+    plug.set_state(on_off=1)
+    plug.state_updated -= plug.state_ttl + 1
+    assert plug.known_state() == {}
+    assert plug.set_state(on_off=1) is not None
+    assert (plug.skipped, passthroughs(cloud)) == (0, 2)
+
+
+def test_forced_commands_are_always_sent(cloud, session):
+    bulb = session.device('stub-bulb')
+    bulb.set_state(on_off=1)
+    bulb._transition_light_state(on_off=1)
+    bulb.on()
+    assert (bulb.skipped, passthroughs(cloud)) == (0, 3)
+    assert bulb.known_state() == {'on_off': 1}
+
+
+def test_failed_commands_forget_the_state(cloud, session):
+    plug = session.device('stub-plug')
+    plug.set_state(on_off=1)
+    cloud.states.clear()
+    plug.off()
+    assert plug.known_state() == {}
+
+
+def test_poll_refreshes_the_cache(cloud, session):
+    plug, bulb = session.device('stub-plug'), session.device('stub-bulb')
+    plug.set_state(on_off=1)
+    # switched from somewhere else
+    cloud.states['stub-plug']['relay_state'] = 0
+    cloud.states['stub-bulb'].update(on_off=1, hue=120, saturation=100)
+    session.poll()
+    assert plug.known_state() == {'on_off': 0}
+    assert bulb.known_state() == {'on_off': 1, 'hue': 120, 'saturation': 100}
+    sent = passthroughs(cloud)
+    assert plug.set_state(on_off=0) is None and bulb.set_state(on_off=1, hue=120) is None
+    assert passthroughs(cloud) == sent
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from dispatch import ALL_DEVICES, Closed, CoalescingQueue, Dispatcher, queue
+
+
+def ready(q):
+    try:
+        return q.get(block=False)
+    except queue.Empty:
+        return None
+
+
+def test_entries_sharing_a_lane_run_in_put_order():
+    q = CoalescingQueue()
+    q.put('bulb', {'on_off': 1})
+    q.put('effect', 'sweep', long_running=True, lanes=['bulb', 'plug'])
+    q.put('plug', {'on_off': 0})
+    assert ready(q) == ('bulb', {'on_off': 1})
+    assert ready(q) is None
+    q.task_done('bulb')
+    assert ready(q) == ('effect', 'sweep')
+    assert ready(q) is None
+    q.task_done('effect')
+    assert ready(q) == ('plug', {'on_off': 0})
+
+
+def test_coalescing_does_not_jump_a_shared_lane():
+    q = CoalescingQueue()
+    q.put('bulb', {'on_off': 1})
+    q.put('other', 1)
+    q.put('bulb', {'hue': 120})
+    assert list(q._order) == ['bulb', 'other']
+    q.put('effect', 'sweep', lanes=['bulb'])
+    q.put('bulb', {'on_off': 0})
+    assert list(q._order) == ['other', 'effect', 'bulb']
+    assert q._pending['bulb'] == {'on_off': 0, 'hue': 120}
+
+
+def test_all_devices_expands_into_one_record_per_batch_while_draining():
+    ran = []
+
+    def handler(key, item):
+        if key == ALL_DEVICES:
+            time.sleep(0.1)
+            for device in ('plug', 'bulb'):
+                dispatcher.submit(device, item)
+            return ()
+        ran.append((key, item))
+        if key == 'bulb':
+            raise IOError('offline')
+        return [key]
+
+    dispatcher = Dispatcher(handler, workers=3).start()
+    dispatcher.submit(ALL_DEVICES, {'on_off': 1}, label='Lumos')
+    dispatcher.close(drain=True, timeout=5)
+    assert sorted(ran) == [('bulb', {'on_off': 1}), ('plug', {'on_off': 1})]
+    records = dispatcher.sink.recent()
+    assert len(records) == 1
+    record = records[0]
+    assert (record.key, record.label, record.results) == (ALL_DEVICES, 'Lumos', ('plug',))
+    assert isinstance(record.error, IOError)
+    assert not any(thread.is_alive() for thread in dispatcher.threads)
+    with pytest.raises(Closed):
+        dispatcher.submit('plug', {'on_off': 0})
+
+
+def test_coalesced_submits_complete_both_batches():
+    release = threading.Event()
+
+    def handler(key, item):
+        release.wait(5)
+        return [item]
+
+    dispatcher = Dispatcher(handler, workers=1).start()
+    dispatcher.submit('busy', 'first', label='Busy')
+    dispatcher.submit('plug', {'on_off': 1}, label='Lumos')
+    dispatcher.submit('plug', {'on_off': 0}, label='Nox')
+    release.set()
+    dispatcher.close(drain=True, timeout=5)
+    records = dispatcher.sink.recent()
+    assert [record.results for record in records] == [('first',), ({'on_off': 0},), ({'on_off': 0},)]
+    assert sorted(record.batches[0] for record in records) == [1, 2, 3]
+
+
+def test_close_without_drain_completes_the_batches_it_drops():
+    submitted = threading.Event()
+    release = threading.Event()
+
+    def handler(key, item):
+        if key == ALL_DEVICES:
+            for device in ('plug', 'bulb'):
+                dispatcher.submit(device, item)
+            submitted.set()
+            release.wait(5)
+            return ['*']
+        return [key]
+
+    dispatcher = Dispatcher(handler, workers=1).start()
+    dispatcher.submit(ALL_DEVICES, {'on_off': 1}, label='Lumos')
+    assert submitted.wait(5)
+    dispatcher.submit('lamp', {'on_off': 0}, label='Nox')
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    dispatcher.close(drain=False, timeout=5)
+    timer.join()
+    records = dispatcher.sink.recent()
+    assert [(record.label, record.results) for record in records] == [('Nox', ()), ('Lumos', ('*',))]
+    assert all(isinstance(record.error, Closed) for record in records)
+    assert not dispatcher.queue._outstanding and not dispatcher.sink._parts
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import tplink
+from cloudstub import StubCloud
+from device import Bulb
+from effects import SCENES, apply_scene
+
+LIGHTING = 'smartlife.iot.smartbulb.lightingservice'
+
+
+@pytest.fixture
+def cloud():
+    cloud = StubCloud().start()
+    yield cloud
+    cloud.stop()
+
+
+@pytest.fixture
+def session(cloud):
+    session = tplink.Session(tplink.TPLink(cloud.endpoint, 'uuid'), cache_file=None, local=False)
+    session.refresh()
+    return session
+
+
+def sent(cloud):
+    """ The transition_light_state arguments of each passthrough so far. """
+    return [json.loads(request['params']['requestData'])[LIGHTING]['transition_light_state']
+            for request in cloud.requests if request['method'] == 'passthrough']
+
+
+def test_transition_is_sent_in_milliseconds(cloud, session):
+    bulbs = session.devices(Bulb)
+    [result] = apply_scene('warm', bulbs, transition=1500, session=session)
+    assert result.error is None
+    assert sent(cloud) == [dict(SCENES['warm'].state, transition_period=1500)]
+
+
+def test_known_state_is_skipped_unless_forced(cloud, session):
+    [bulb] = session.devices(Bulb)
+    apply_scene('night', [bulb], session=session)
+    [result] = apply_scene('night', [bulb], session=session)
+    assert (result.response, result.error, bulb.skipped) == (None, None, 1)
+    assert len(sent(cloud)) == 1
+    apply_scene('night', [bulb], force=True, session=session)
+    assert sent(cloud)[1:] == [SCENES['night'].state]
+
+
+def test_cloud_errors_are_reported_per_bulb(cloud, session):
+    bulbs = session.devices(Bulb)
+    cloud.states.clear()
+    [result] = apply_scene('red', bulbs, force=True, session=session)
+    assert isinstance(result.error, tplink.CloudError)
+    # without a session the error response is returned as is
+    [result] = apply_scene('red', bulbs, force=True)
+    assert result.error is None and result.response['error_code'] == -20571
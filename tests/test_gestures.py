@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+
+from gestures import Cooldown, GestureClassifier
+
+PATTERNS = [('Lumos', ('right', 'up')), ('Nox', ('right', 'down')), ('Twice', ('right', 'right', 'up'))]
+MOVES = {'right': (10, 0), 'left': (-10, 0), 'up': (0, -10), 'down': (0, 10), 'none': (1, 1)}
+
+
+def frame(*moves):
+    """ good_new, good_old for one frame with a point moving each way. """
+    good_old = np.array([[100.0, 100.0]] * len(moves), np.float32)
+    good_new = good_old + np.array([MOVES[move] for move in moves], np.float32)
+    return good_new, good_old
+
+
+def feed(classifier, *moves):
+    return [classifier.classify(*frame(move)) for move in moves]
+
+
+def test_moves_are_classified_by_direction():
+    classifier = GestureClassifier(PATTERNS)
+    good_new, good_old = frame('right', 'left', 'up', 'down', 'none')
+    assert list(classifier.moves(good_new, good_old)) == [2, 1, 3, 4, 0]
+
+
+def test_pattern_matches_consecutive_directions_ignoring_pauses():
+    classifier = GestureClassifier(PATTERNS)
+    assert feed(classifier, 'right', 'none', 'none', 'up') == [None, None, None, 'Lumos']
+    # completing a pattern clears every track
+    assert classifier.history(0) == [] and not classifier.states.any()
+
+
+def test_other_directions_break_a_pattern():
+    classifier = GestureClassifier(PATTERNS)
+    assert feed(classifier, 'right', 'left', 'up') == [None, None, None]
+    assert classifier.history(0) == ['right', 'left', 'up']
+
+
+def test_repeated_prefix_falls_back_instead_of_restarting():
+    classifier = GestureClassifier([('Twice', ('right', 'right', 'up'))])
+    assert feed(classifier, 'right', 'right', 'right', 'up') == [None, None, None, 'Twice']
+
+
+def test_tracks_advance_independently():
+    classifier = GestureClassifier(PATTERNS, max_tracks=2)
+    assert classifier.classify(*frame('right', 'up')) is None
+    assert classifier.classify(*frame('none', 'right')) is None
+    # a third point is beyond max_tracks
+    assert classifier.classify(*frame('left', 'none', 'up')) is None
+    assert classifier.classify(*frame('up', 'up')) == 'Lumos'
+
+
+def test_earlier_patterns_win():
+    classifier = GestureClassifier(PATTERNS)
+    assert feed(classifier, 'right', 'right', 'up') == [None, None, 'Lumos']
+
+
+def test_cooldown_suppresses_repeats_per_spell():
+    now = [0.0]
+    cooldown = Cooldown(default=3.0, durations={'Nox': 1.0}, clock=lambda: now[0])
+    assert cooldown.trigger('Lumos') and cooldown.trigger('Nox')
+    now[0] = 2.0
+    assert not cooldown.trigger('Lumos') and cooldown.remaining('Lumos') == 1.0
+    assert cooldown.trigger('Nox')
+    assert cooldown.suppressed == 1
+    # a suppressed cast does not extend the cooldown
+    now[0] = 3.0
+    assert cooldown.trigger('Lumos')
+    cooldown.reset('Lumos')
+    assert cooldown.ready('Lumos') and 'Nox' in cooldown.last
+    cooldown.reset()
+    assert not cooldown.last
+
+
+def test_cooldown_uses_a_monotonic_clock():
+    assert Cooldown().clock is getattr(time, 'monotonic', time.time)
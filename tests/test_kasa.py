@@ -0,0 +1,45 @@
+import pytest
+
+from kasa import LocalTransport, StubDevice, decrypt, discover, encrypt
+
+SYSINFO = {'system': {'get_sysinfo': {}}}
+
+
+@pytest.fixture
+def stub():
+    device = StubDevice(deviceId='stub-plug', alias='Stub Plug').start()
+    yield device
+    device.stop()
+
+
+def test_encrypt_is_the_xor_autokey_cipher():
+    # the first byte is XORed with the initial key, 171
+    assert encrypt(b'{')[0:1] == b'\xd0'
+    assert encrypt(b'{"') == b'\xd0\xf2'
+
+
+@pytest.mark.parametrize('data', [b'', b'{"system":{"get_sysinfo":{}}}', bytes(bytearray(range(256)))])
+def test_decrypt_undoes_encrypt(data):
+    assert decrypt(encrypt(data)) == data
+
+
+def test_local_transport_round_trip(stub):
+    transport = LocalTransport(stub.host, stub.port)
+    answer = transport.request(SYSINFO)
+    assert answer['system']['get_sysinfo']['deviceId'] == 'stub-plug'
+    resp = transport.send({'system': {'set_relay_state': {'state': 1}}})
+    assert resp == {'error_code': 0, 'result': {'responseData': {'system': {'set_relay_state': {'err_code': 0}}}}}
+    assert stub.requests[-1] == {'system': {'set_relay_state': {'state': 1}}}
+
+
+def test_local_transport_raises_when_nothing_listens(stub):
+    port = stub.port
+    stub.stop()
+    with pytest.raises(IOError):
+        LocalTransport('127.0.0.1', port, timeout=0.5).request(SYSINFO)
+
+
+def test_discover_finds_the_stub(stub):
+    found = discover(timeout=0.5, address=stub.host, port=stub.port)
+    assert found == [{'deviceId': 'stub-plug', 'alias': 'Stub Plug', 'deviceType': 'IOT.SMARTPLUGSWITCH',
+                      'host': stub.host, 'port': stub.port}]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from recognizer import StrokeCollector, TemplateRecognizer
+
+
+def path(*corners, **kwargs):
+    """ A stroke through corners with steps points per segment. """
+    steps = kwargs.get('steps', 10)
+    points = [np.linspace(a, b, steps, endpoint=False) for a, b in zip(corners, corners[1:])]
+    return np.concatenate(points + [np.array(corners[-1:], np.float32)]).astype(np.float32)
+
+
+LUMOS = path((0, 0), (100, 0), (100, -100))
+NOX = path((0, 0), (100, 0), (100, 100))
+
+
+@pytest.fixture
+def recognizer():
+    recognizer = TemplateRecognizer()
+    recognizer.add('Lumos', LUMOS)
+    recognizer.add('Nox', NOX)
+    return recognizer
+
+
+def test_noisy_stroke_matches_its_template(recognizer):
+    noise = np.random.RandomState(0).uniform(-4, 4, LUMOS.shape)
+    # drawn smaller, elsewhere in the frame and shakily
+    stroke = LUMOS * 0.6 + (320, 240) + noise
+    name, score = recognizer.recognize(stroke)
+    assert name == 'Lumos' and recognizer.threshold <= score < 1.0
+    assert recognizer.recognize(NOX)[0] == 'Nox'
+
+
+def test_off_template_stroke_is_rejected(recognizer):
+    angles = np.linspace(0, 2 * np.pi, 40)
+    circle = np.stack((np.cos(angles), np.sin(angles)), axis=1) * 60
+    name, score = recognizer.recognize(circle)
+    assert name is None and score < recognizer.threshold
+
+
+def test_short_strokes_are_not_matched(recognizer):
+    assert recognizer.recognize(LUMOS * 0.05) == (None, 0.0)
+    assert recognizer.recognize(LUMOS[:1]) == (None, 0.0)
+    assert TemplateRecognizer().recognize(LUMOS) == (None, 0.0)
+
+
+def test_templates_survive_save_and_load(recognizer, tmpdir):
+    out = str(tmpdir.join('gestures.npz'))
+    recognizer.save(out)
+    loaded = TemplateRecognizer.load(out)
+    assert loaded.names == ['Lumos', 'Nox']
+    assert loaded.recognize(LUMOS) == recognizer.recognize(LUMOS)
+
+
+def test_collector_cuts_strokes_when_the_point_stops():
+    collector = StrokeCollector(max_tracks=1, idle_frames=3)
+    strokes = [collector.add(point[None]) for point in LUMOS]
+    strokes += [collector.add(LUMOS[-1:]) for i in range(3)]
+    [(track, stroke)] = sum(strokes, [])
+    assert track == 0 and np.array_equal(stroke, LUMOS)
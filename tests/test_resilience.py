@@ -0,0 +1,157 @@
+import time
+
+import pytest
+
+from cloudstub import StubCloud
+from device import ConnectionPool
+from resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, Resilience
+
+LOGIN = {'method': 'login', 'params': {'appType': 'Kasa_Android', 'cloudUserName': 'user',
+                                       'cloudPassword': 'password', 'terminalUUID': 'uuid'}}
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def cloud():
+    cloud = StubCloud().start()
+    yield cloud
+    cloud.stop()
+
+
+def login(pool, **kwargs):
+    return pool.post(url=pool.endpoint, json=LOGIN, idempotent=True, **kwargs).json()
+
+
+def test_injected_latency(cloud):
+    cloud.latency = 0.2
+    pool = ConnectionPool(cloud.endpoint, timeout=None, deadline=2.0)
+    started = time.time()
+    assert login(pool)['result']['token'] == 'stub-token'
+    assert time.time() - started >= 0.2
+
+
+def test_deadline_bounds_a_slow_answer(cloud):
+    cloud.latency = 1.0
+    pool = ConnectionPool(cloud.endpoint, timeout=None, deadline=0.3, backoff=0.1)
+    started = time.time()
+    with pytest.raises(IOError):
+        login(pool)
+    assert time.time() - started < 0.9
+
+
+def test_no_retry_that_would_end_past_the_deadline():
+    clock = Clock()
+
+    def attempt(remaining):
+        clock.now += 0.8
+        raise IOError('timed out')
+
+    resilience = Resilience(deadline=1.0, retries=5, backoff=0.5, clock=clock, sleep=clock.sleep)
+    with pytest.raises(IOError):
+        resilience.call(attempt, idempotent=True)
+    assert resilience.attempts == 1
+    assert clock.slept == []
+
+
+def test_deadline_exceeded_without_time_for_an_attempt():
+    clock = Clock()
+    resilience = Resilience(clock=clock, sleep=clock.sleep)
+    with pytest.raises(DeadlineExceeded):
+        resilience.call(lambda remaining: 'late', deadline=0)
+    assert resilience.attempts == 0
+
+
+def test_retries_failures_with_backoff(cloud):
+    cloud.fail_next = 2
+    pool = ConnectionPool(cloud.endpoint, retries=2, backoff=0.05)
+    assert login(pool)['error_code'] == 0
+    assert pool.stats()['retried'] == 2
+
+
+def test_backoff_doubles_up_to_max_backoff():
+    clock = Clock()
+
+    def attempt(remaining):
+        raise IOError('unavailable')
+
+    resilience = Resilience(deadline=60.0, retries=4, backoff=0.5, max_backoff=1.5,
+                            breaker=CircuitBreaker(failures=10, clock=clock), clock=clock, sleep=clock.sleep)
+    with pytest.raises(IOError):
+        resilience.call(attempt, idempotent=True)
+    assert clock.slept == [0.5, 1.0, 1.5, 1.5]
+    assert resilience.attempts == 5
+
+
+def test_non_idempotent_calls_are_not_retried(cloud):
+    cloud.fail_next = 1
+    pool = ConnectionPool(cloud.endpoint, retries=2, backoff=0.05)
+    with pytest.raises(IOError):
+        pool.post(url=pool.endpoint, json=LOGIN)
+    assert pool.stats()['attempts'] == 1
+
+
+def test_breaker_opens_then_half_opens_then_closes(cloud):
+    cloud.fail_next = 2
+    pool = ConnectionPool(cloud.endpoint, retries=0, failures=2, reset_timeout=0.2)
+    for i in range(2):
+        with pytest.raises(IOError):
+            login(pool)
+    assert pool.stats()['breaker'] == CircuitBreaker.OPEN
+    requests = len(cloud.requests)
+    with pytest.raises(CircuitOpen):
+        login(pool)
+    assert len(cloud.requests) == requests
+    time.sleep(0.25)
+    assert pool.stats()['breaker'] == CircuitBreaker.HALF_OPEN
+    assert login(pool)['error_code'] == 0
+    assert pool.stats()['breaker'] == CircuitBreaker.CLOSED
+
+
+def test_failed_trial_opens_the_breaker_again():
+    clock = Clock()
+    breaker = CircuitBreaker(failures=1, reset_timeout=10.0, clock=clock)
+    resilience = Resilience(retries=0, breaker=breaker, clock=clock, sleep=clock.sleep)
+
+    def fail(remaining):
+        raise IOError('unavailable')
+
+    with pytest.raises(IOError):
+        resilience.call(fail)
+    clock.now += 10.0
+    with pytest.raises(IOError):
+        resilience.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_unexpected_error_in_trial_does_not_wedge_the_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(failures=1, reset_timeout=10.0, clock=clock)
+    resilience = Resilience(retries=0, breaker=breaker, clock=clock, sleep=clock.sleep)
+
+    def fail(remaining):
+        raise IOError('unavailable')
+
+    def malformed(remaining):
+        raise ValueError('not JSON')
+
+    with pytest.raises(IOError):
+        resilience.call(fail)
+    clock.now += 10.0
+    with pytest.raises(ValueError):
+        resilience.call(malformed)
+    clock.now += 10.0
+    assert resilience.call(lambda remaining: 'ok') == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
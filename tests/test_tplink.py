@@ -0,0 +1,43 @@
+import json
+import os
+import stat
+import threading
+import time
+
+import tplink
+from cloudstub import StubCloud
+
+
+def test_cache_is_written_for_the_owner_only(tmpdir):
+    cloud = StubCloud().start()
+    try:
+        cache_file = str(tmpdir.join('cache.json'))
+        # a stale partial file must not pass its mode on
+        with open(cache_file + '.partial', 'w') as f:
+            f.write('{}')
+        os.chmod(cache_file + '.partial', 0o644)
+        session = tplink.Session(tplink.TPLink(cloud.endpoint, 'uuid'), cache_file=cache_file, local=False)
+        session.refresh()
+        assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+        with open(cache_file) as f:
+            assert json.load(f)['token'] == 'stub-token'
+    finally:
+        cloud.stop()
+
+
+def test_lookups_do_not_wait_for_a_refresh():
+    cloud = StubCloud().start()
+    try:
+        session = tplink.Session(tplink.TPLink(cloud.endpoint, 'uuid'), cache_file=None, local=False)
+        session.refresh()
+        cloud.latency = 1.0
+        refresh = threading.Thread(target=session.refresh)
+        refresh.start()
+        time.sleep(0.2)
+        started = time.time()
+        assert session.device('stub-plug') is not None
+        assert len(session.devices()) == 2
+        assert time.time() - started < 0.2
+        refresh.join()
+    finally:
+        cloud.stop()
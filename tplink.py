@@ -1,9 +1,11 @@
 import yaml
 import json
-import requests
+import os
+import threading
 import time
-from config import _CONFIG_FILE
-from device import DeviceFactory, Bulb, Plug
+from config import _CONFIG_FILE, _CACHE_FILE
+from device import DeviceFactory, Bulb, DEVICE_TYPES, fan_out
+from kasa import LocalTransport, discover, PORT as _LOCAL_PORT
 from collections import defaultdict
 import logging
 
@@ -46,35 +48,48 @@ class TPLink(object):
         self.uuid = uuid or self.config['tplink']['uuid']
         self.methods = _METHODS
 
-    def login(self, username=None, password=None, uuid=None):
-        uuid = uuid or self.uuid
-        data = {
+    def _login_data(self, username=None, password=None, uuid=None):
+        return {
             "method": self.methods.get('login'),
             "params": {
                 "appType": self.config['tplink']['appType'],
                 "cloudUserName": username or self.config['tplink']['username'],
                 "cloudPassword": password or self.config['tplink']['password'],
-                "terminalUUID": uuid
+                "terminalUUID": uuid or self.uuid
             }
         }
-        resp = requests.post(self.endpoint, json=data).json()
-        self.token = resp['result']['token']
-        return resp
 
-    def getDeviceList(self):
-        data = {
+    def _device_list_data(self):
+        return {
             "method": self.methods.get('getDeviceList'),
             "params": {
                 "token": self.token
             }
         }
+
+    def _store_devices(self, resp):
+        self.devicesById = self.devicesById if hasattr(self,'devicesById') else {}
+        self.devicesByAlias = self.devicesByAlias if hasattr(self,'devicesByAlias') else {}
+        for device in resp['result']['deviceList']:
+            self.devicesById[device['deviceId']] = device
+            self.devicesByAlias[device['alias']] = device
+
+    @property
+    def pool(self):
+        # the same connections, deadlines and circuit breaker the devices use
+        return DeviceFactory(self.endpoint).pool(self.endpoint)
+
+    def login(self, username=None, password=None, uuid=None):
+        data = self._login_data(username, password, uuid)
+        resp = self.pool.post(url=self.endpoint, json=data, idempotent=True).json()
+        self.token = resp['result']['token']
+        return resp
+
+    def getDeviceList(self):
+        data = self._device_list_data()
         try:
-            resp = requests.post(self.endpoint, json=data).json()
-            self.devicesById = self.devicesById if hasattr(self,'devicesById') else {}
-            self.devicesByAlias = self.devicesByAlias if hasattr(self,'devicesByAlias') else {}
-            for device in resp['result']['deviceList']:
-                self.devicesById[device['deviceId']] = device
-                self.devicesByAlias[device['alias']] = device
+            resp = self.pool.post(url=self.endpoint, json=data, idempotent=True).json()
+            self._store_devices(resp)
             return resp
         except Exception as e:
             logging.error(e)
@@ -87,23 +102,278 @@ class TPLink(object):
         return self.devicesById[deviceId]
 
 
+# error_code values the cloud returns for a token it no longer accepts
+_TOKEN_ERRORS = (-20651, -20675)
+
+
+def _rejected(resp):
+    return isinstance(resp, dict) and resp.get('error_code') in _TOKEN_ERRORS
+
+
+class CloudError(Exception):
+    """ The cloud answered a request with a non-zero error_code. """
+
+    def __init__(self, resp):
+        self.error_code = resp.get('error_code')
+        self.msg = resp.get('msg')
+        Exception.__init__(self, 'error_code {}: {}'.format(self.error_code, self.msg))
+
+
+class Session(object):
+    """ A long-lived cloud session, so that casting a spell doesn't have to
+        log in and fetch the device list first.
+
+        The token is reused until token_ttl seconds have passed or the cloud
+        rejects it, and then renewed with a fresh login.  The device list is
+        kept in memory and in cache_file, together with the token, so a
+        restart doesn't need the cloud either; a background thread refreshes
+        it every refresh_interval seconds once start() is called.  Devices
+        are built once and kept across refreshes, and every poll_interval
+        seconds their cached state is confirmed with get_sysinfo.
+
+        With local set (or `local: true` in tplink.yaml) each refresh also
+        broadcasts for devices on the LAN, and devices that answer are sent
+        commands directly instead of through the cloud.  If the cloud is
+        unreachable, the devices found locally are used on their own.
+    """
+
+    def __init__(self, tplink=None, cache_file=_CACHE_FILE, token_ttl=12 * 3600, refresh_interval=300,
+                 local=None, discovery_timeout=2.0, poll_interval=60):
+        self.tplink = tplink or TPLink()
+        self.cache_file = cache_file
+        self.token_ttl = token_ttl
+        self.refresh_interval = refresh_interval
+        self.poll_interval = poll_interval
+        if local is None:
+            local = self.tplink.config['tplink'].get('local', False)
+        self.local = local
+        self.discovery_timeout = discovery_timeout
+        self.factory = DeviceFactory(self.tplink.endpoint)
+        self.devicesById = {}
+        self.specsById = {}
+        self.token_expires = 0
+        self.refreshed = 0
+        self.stoprequest = threading.Event()
+        # _lock guards the registry and token only; logins and refreshes
+        # talk to the network under their own locks, so lookups never wait on them
+        self._lock = threading.RLock()
+        self._login_lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._load_cache()
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring device cache {}: {}'.format(self.cache_file, e))
+            return
+        if cache.get('endpoint') != self.tplink.endpoint:
+            return
+        if cache.get('token') and cache.get('token_expires', 0) > time.time():
+            self.tplink.token = cache['token']
+            self.token_expires = cache['token_expires']
+        self._update_devices(cache.get('deviceList', []))
+        self.refreshed = cache.get('refreshed', 0)
+
+    def _save_cache(self, deviceList):
+        if not self.cache_file:
+            return
+        cache = {
+            'endpoint': self.tplink.endpoint,
+            'token': getattr(self.tplink, '_token', None),
+            'token_expires': self.token_expires,
+            'refreshed': self.refreshed,
+            'deviceList': deviceList
+        }
+        partial = self.cache_file + '.partial'
+        try:
+            # the cache holds the cloud token, so only the owner may read it
+            if os.path.exists(partial):
+                os.remove(partial)
+            with os.fdopen(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(cache, f)
+            os.rename(partial, self.cache_file)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write device cache {}: {}'.format(self.cache_file, e))
+
+    def _update_devices(self, deviceList):
+        devices = {}
+        for spec in deviceList:
+            device = self.devicesById.get(spec['deviceId'])
+            if device is None or device.__class__ is not DEVICE_TYPES.get(spec.get('deviceType')):
+                device = self.factory.buildDevice(spec)
+            device.alias = spec.get('alias')
+            if self.token_expires:
+                device.token = self.tplink.token
+            if not spec.get('host'):
+                device.transport = None
+            elif device.transport is None or device.transport.host != spec['host']:
+                device.transport = LocalTransport(spec['host'], spec.get('port', _LOCAL_PORT))
+            devices[spec['deviceId']] = device
+        self.devicesById = devices
+        self.specsById = dict((spec['deviceId'], spec) for spec in deviceList)
+
+    def _ensure_login(self):
+        if time.time() >= self.token_expires:
+            with self._login_lock:
+                if time.time() >= self.token_expires:
+                    self.login()
+
+    @property
+    def token(self):
+        self._ensure_login()
+        return self.tplink.token
+
+    def login(self):
+        with self._login_lock:
+            resp = self.tplink.login()
+            with self._lock:
+                self.token_expires = time.time() + self.token_ttl
+                for device in self.devicesById.values():
+                    device.token = self.tplink.token
+            logging.info('Logged in to {}'.format(self.tplink.endpoint))
+            return resp
+
+    def _fetch_device_list(self):
+        self._ensure_login()
+        try:
+            resp = self.tplink.getDeviceList()
+        except Exception:
+            # a rejected token shows up as a response without a result
+            self.login()
+            resp = self.tplink.getDeviceList()
+        return resp['result']['deviceList']
+
+    def refresh(self):
+        """ Fetch the device list from the cloud (and the LAN, if local) and
+            update the registry.  Lookups keep answering from the previous
+            registry until the new one is swapped in.
+        """
+        with self._refresh_lock:
+            specs = {}
+            known_specs = self.specsById
+            if self.local:
+                for spec in discover(self.discovery_timeout):
+                    specs[spec['deviceId']] = spec
+            try:
+                for spec in self._fetch_device_list():
+                    known = specs.get(spec['deviceId']) or known_specs.get(spec['deviceId'], {})
+                    spec = dict(spec)
+                    if known.get('host'):
+                        spec['host'] = known['host']
+                        spec['port'] = known.get('port', _LOCAL_PORT)
+                    specs[spec['deviceId']] = spec
+            except Exception as e:
+                if not specs:
+                    raise
+                logging.warning('Cloud unavailable, using {} local devices: {}'.format(len(specs), e))
+            deviceList = list(specs.values())
+            with self._lock:
+                self._update_devices(deviceList)
+                self.refreshed = time.time()
+                devices = list(self.devicesById.values())
+            self._save_cache(deviceList)
+            return devices
+
+    def devices(self, cls=None):
+        with self._lock:
+            devices = list(self.devicesById.values())
+        if not devices:
+            devices = self.refresh()
+        elif any(device.transport is None for device in devices):
+            self._ensure_login()
+        if cls is not None:
+            devices = [device for device in devices if isinstance(device, cls)]
+        return devices
+
+    def device(self, deviceId):
+        """ The registered device with this id, or None. """
+        with self._lock:
+            return self.devicesById.get(deviceId)
+
+    def call(self, device, action, *args, **kwargs):
+        """ Run device.action(*args), logging in again and retrying once if
+            the cloud rejects the token.  Any other non-zero error_code (or a
+            rejection that survives the new login) raises CloudError.
+        """
+        resp = getattr(device, action)(*args, **kwargs)
+        if _rejected(resp):
+            logging.info('Token rejected for {}, logging in again'.format(device.alias))
+            self.login()
+            resp = getattr(device, action)(*args, **kwargs)
+        if isinstance(resp, dict) and resp.get('error_code', 0) != 0:
+            raise CloudError(resp)
+        return resp
+
+    def command(self, action, *args, **kwargs):
+        """ Send the same command to every device (or those in devices=)
+            concurrently and return a GroupResult per device.  deadline=
+            bounds the whole call in seconds.
+        """
+        devices = kwargs.pop('devices', None)
+        deadline = kwargs.pop('deadline', 5.0)
+        if devices is None:
+            devices = self.devices()
+        elif any(device.transport is None for device in devices):
+            self._ensure_login()
+        results = fan_out(devices, lambda device: self.call(device, action, *args, **kwargs), deadline)
+        for result in results:
+            if result.error is not None:
+                logging.error('{} {}: {}'.format(result.device.alias, action, result.error))
+        return results
+
+    def poll(self):
+        """ Update every device's cached state from get_sysinfo. """
+        return self.command('get_sysinfo')
+
+    def _refresh_loop(self):
+        while not self.stoprequest.wait(self.poll_interval or self.refresh_interval):
+            try:
+                if time.time() - self.refreshed >= self.refresh_interval:
+                    self.refresh()
+                if self.poll_interval:
+                    self.poll()
+            except Exception as e:
+                logging.error('Device list refresh failed: {}'.format(e))
+
+    def start(self):
+        """ Start refreshing the device list (and polling device state) in
+            the background.
+        """
+        with self._lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self.stoprequest.clear()
+                self._refresher = threading.Thread(target=self._refresh_loop, name='TPLinkRefresher')
+                self._refresher.daemon = True
+                self._refresher.start()
+
+    def stop(self):
+        self.stoprequest.set()
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def session():
+    """ The shared Session, created and started on first use. """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = Session()
+            _SESSION.start()
+        return _SESSION
+
+
 def allOff():
-    l = TPLink()
-    logging.info(l.login())
-    factory = DeviceFactory(l.endpoint)
-    for device in l.getDeviceList()['result']['deviceList']:
-        device = factory.buildDevice(device)
-        device.token = l.token
-        device.off()
+    return session().command('off')
 
 def allOn():
-    l = TPLink()
-    logging.info(l.login())
-    factory = DeviceFactory(l.endpoint)
-    for device in l.getDeviceList()['result']['deviceList']:
-        device = factory.buildDevice(device)
-        device.token = l.token
-        device.on()
+    return session().command('on')
 
 def test():
     l = TPLink()
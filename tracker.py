@@ -0,0 +1,254 @@
+import time
+import numpy as np
+import cv2
+
+from metrics import METRICS
+
+_EMPTY = np.empty((0, 2), np.float32)
+
+
+def roi_windows(points, shape, pad):
+    """ Return padded (x0, y0, x1, y1) windows around points, clipped to an
+        image of the given shape, with overlapping windows merged.
+    """
+    height, width = shape[:2]
+    windows = []
+    for x, y in points.reshape(-1, 2):
+        windows.append([max(int(x) - pad, 0), max(int(y) - pad, 0),
+                        min(int(x) + pad + 1, width), min(int(y) + pad + 1, height)])
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                  max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(w) for w in windows]
+
+
+class RoiTracker(object):
+    """ Tracks wand points with optical flow inside padded windows around
+        them instead of over the whole frame.
+
+        start() preprocesses the windows around the given points in a frame;
+        track() preprocesses the same windows in the next frame and runs
+        calcOpticalFlowPyrLK inside each, returning points in full-frame
+        coordinates in the same (n, 1, 2) layout as p0.  Points that leave
+        their window are reported as lost (st == 0).  advance() keeps the
+        windows, and what track() preprocessed of them, as long as every
+        point is still at least margin pixels (pad / 2 by default) inside
+        one, so a steadily tracked wand costs one preprocessing pass per
+        window per frame.  Windows are preprocessed with CLAHE tiles sized
+        as on the full frame (see Preprocessor).
+
+        When the windows would cover more than max_coverage of the frame,
+        a single full-frame window is used instead.
+    """
+
+    def __init__(self, preprocessor, lk_params, pad=48, max_coverage=0.5, margin=None):
+        self.preprocessor = preprocessor
+        self.lk_params = lk_params
+        self.pad = pad
+        self.max_coverage = max_coverage
+        self.margin = pad // 2 if margin is None else margin
+        self.points = None
+        self._windows = []
+        self._grays = None
+
+    @property
+    def active(self):
+        return self.points is not None and len(self.points) > 0
+
+    def reset(self):
+        self.points = None
+        self._windows = []
+        self._grays = None
+
+    def _layout(self, points, shape):
+        windows = roi_windows(points, shape, self.pad)
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows)
+        if area > self.max_coverage * shape[0] * shape[1]:
+            windows = [(0, 0, shape[1], shape[0])]
+        flat = points.reshape(-1, 2)
+        layout = []
+        for x0, y0, x1, y1 in windows:
+            inside = np.nonzero((flat[:, 0] >= x0) & (flat[:, 0] < x1) &
+                                (flat[:, 1] >= y0) & (flat[:, 1] < y1))[0]
+            if len(inside):
+                layout.append(((x0, y0, x1, y1), inside))
+        return layout
+
+    def start(self, frame, points, grays=None):
+        """ Begin tracking points located in frame.  grays may hold already
+            preprocessed windows of this frame, keyed by window.
+        """
+        self.points = points
+        self._windows = []
+        if points is None or len(points) == 0:
+            return
+        for window, inside in self._layout(points, frame.shape):
+            gray = grays.get(window) if grays else None
+            if gray is None:
+                x0, y0, x1, y1 = window
+                gray = self.preprocessor.apply(frame[y0:y1, x0:x1], frame.shape).copy()
+            self._windows.append((window, inside, gray))
+
+    def track(self, frame):
+        """ Track the current points into frame and return (p1, st) in the
+            layout calcOpticalFlowPyrLK uses.  Call advance() with the
+            points to keep tracking afterwards.
+        """
+        p0 = self.points.reshape(-1, 1, 2).astype(np.float32)
+        p1 = p0.copy()
+        st = np.zeros((len(p0), 1), np.uint8)
+        self._grays = {}
+        for window, inside, old_gray in self._windows:
+            x0, y0, x1, y1 = window
+            gray = self.preprocessor.apply(frame[y0:y1, x0:x1], frame.shape).copy()
+            self._grays[window] = gray
+            offset = np.array([x0, y0], np.float32)
+            with METRICS.timer('optical_flow'):
+                moved, status, err = cv2.calcOpticalFlowPyrLK(
+                    old_gray, gray, p0[inside] - offset, None, **self.lk_params)
+            moved = moved + offset
+            flat = moved.reshape(-1, 2)
+            kept = ((flat[:, 0] >= x0) & (flat[:, 0] < x1) &
+                    (flat[:, 1] >= y0) & (flat[:, 1] < y1)).reshape(-1, 1)
+            p1[inside] = moved
+            st[inside] = status * kept
+        return p1, st
+
+    def _kept(self, points, shape, grays):
+        """ The current windows with the grays track() made of them, laid
+            out for points, or None if a point is not well inside them.
+        """
+        height, width = shape[:2]
+        flat = points.reshape(-1, 2)
+        owner = np.full(len(flat), -1)
+        for i, (window, inside, old_gray) in enumerate(self._windows):
+            x0, y0, x1, y1 = window
+            # no margin where the window already reaches the frame edge
+            x0 = x0 + self.margin if x0 > 0 else 0
+            y0 = y0 + self.margin if y0 > 0 else 0
+            x1 = x1 - self.margin if x1 < width else width
+            y1 = y1 - self.margin if y1 < height else height
+            within = ((flat[:, 0] >= x0) & (flat[:, 0] < x1) &
+                      (flat[:, 1] >= y0) & (flat[:, 1] < y1))
+            owner[(owner < 0) & within] = i
+        if (owner < 0).any():
+            return None
+        windows = []
+        for i, (window, inside, old_gray) in enumerate(self._windows):
+            inside = np.nonzero(owner == i)[0]
+            if len(inside) and window in grays:
+                windows.append((window, inside, grays[window]))
+            elif len(inside):
+                return None
+        return windows
+
+    def advance(self, frame, points):
+        """ Continue tracking points (usually the good points returned by
+            track()) from frame, keeping the current windows while the
+            points stay well inside them and reusing what track()
+            preprocessed either way.
+        """
+        grays, self._grays = self._grays, None
+        if grays and points is not None and len(points):
+            windows = self._kept(points, frame.shape, grays)
+            if windows is not None:
+                self.points = points
+                self._windows = windows
+                return
+        self.start(frame, points, grays)
+
+
+class WandTracker(object):
+    """ Owns the wand points and decides when to look for new ones.
+
+        update() is called once per frame from the tracking loop.  It tracks
+        the current points with optical flow (inside ROI windows when a
+        RoiTracker is given) and re-runs detection on that same frame only
+        when fewer than min_points are being tracked or interval seconds
+        have passed since the last detection.  Detection and tracking share
+        one thread, so new points replace the old ones atomically between
+        frames.
+    """
+
+    def __init__(self, preprocessor, detector, lk_params, roi=None,
+                 interval=3.0, min_points=1, clock=time.time):
+        self.preprocessor = preprocessor
+        self.detector = detector
+        self.lk_params = lk_params
+        self.roi = roi
+        self.interval = interval
+        self.min_points = min_points
+        self.clock = clock
+        self.p0 = None
+        self.old_gray = None
+        self.detected_at = None
+        self.detections = 0
+        self.redetected = False
+
+    @property
+    def tracking(self):
+        return self.p0 is not None and len(self.p0) >= self.min_points
+
+    def _due(self, now):
+        if not self.tracking or self.detected_at is None:
+            return True
+        return self.interval is not None and now - self.detected_at >= self.interval
+
+    def redetect(self, frame, now=None):
+        """ Run detection on frame and, if anything is found, start tracking
+            the new points from it.  Returns True when points were replaced.
+        """
+        gray = self.preprocessor.apply(frame)
+        with METRICS.timer('detect'):
+            found = self.detector.detect(gray)
+        self.detected_at = self.clock() if now is None else now
+        self.detections += 1
+        if found is None and self.tracking:
+            # keep following what we have rather than dropping it
+            return False
+        self.p0 = found
+        if self.roi is not None:
+            self.roi.start(frame, found)
+        elif found is not None:
+            self.old_gray = gray.copy()
+        return found is not None
+
+    def update(self, frame):
+        """ Advance tracking to frame and return (good_new, good_old) as
+            (k, 2) arrays.  Both are empty on frames where points were
+            (re)detected; check redetected to reset per-track state.
+        """
+        now = self.clock()
+        self.redetected = False
+        if self._due(now):
+            self.redetected = self.redetect(frame, now)
+            if self.redetected or not self.tracking:
+                return _EMPTY, _EMPTY
+        if self.roi is not None:
+            p1, st = self.roi.track(frame)
+            gray = None
+        else:
+            gray = self.preprocessor.apply(frame)
+            with METRICS.timer('optical_flow'):
+                p1, st, err = cv2.calcOpticalFlowPyrLK(self.old_gray, gray, self.p0, None, **self.lk_params)
+        good_new = p1[st == 1]
+        good_old = self.p0[st == 1]
+        self.p0 = good_new.reshape(-1, 1, 2)
+        if self.roi is not None:
+            self.roi.advance(frame, self.p0)
+        elif self.old_gray is None or self.old_gray.shape != gray.shape:
+            self.old_gray = gray.copy()
+        else:
+            np.copyto(self.old_gray, gray)
+        return good_new, good_old